@@ -12,14 +12,30 @@ import alembic.config
 from sqlalchemy.orm import joinedload
 import gunicorn.app.wsgiapp
 
-from . import models, mail, web
+from . import models, mail, web, utils, explain
+from .utils.parser import parse_pool, set_backend, counters as parse_counters
+from .utils.replay import ReplayServer
+from .utils.cache import ParseCache
 from .config import Config
+from .engine import AsyncEngine
 from . import db
 
 
 logger = logging.getLogger(__name__)
 
 
+def shard_type(value):
+    """Parse "i/N" into (i, N), 0 <= i < N."""
+    try:
+        i, n = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard should be i/N: %s" % value)
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError("shard should be 0 <= i < N: %s"
+                                         % value)
+    return i, n
+
+
 class Command:
 
     parser = argparse.ArgumentParser()
@@ -43,12 +59,82 @@ class Command:
     subparser.add_argument('-f', '--force', action='store_true',
                            help="create a new batch job even if the last batch"
                                 " job not finished")
+    subparser.add_argument('-e', '--engine', choices=["sync", "async"],
+                           default="sync",
+                           help="run jobs one by one, or concurrently in an"
+                                " asyncio event loop")
+    subparser.add_argument('--deep-check', action='store_true',
+                           help="check the result of the lianjia batch job"
+                                " by scanning the tables, instead of by the"
+                                " counters of the batch")
+    subparser.add_argument('--shard', action='store', type=shard_type,
+                           help="track only the i-th of N shards of lianjia"
+                                " communities, 0 <= i < N. The batch job"
+                                " finishes when all the shards are done.")
+    subparser.add_argument('--record-dir', action='store',
+                           default=argparse.SUPPRESS,
+                           help="save the responses in this directory, to be"
+                                " served by replay")
+    subparser.add_argument('--base-url', action='store',
+                           default=argparse.SUPPRESS,
+                           help="send the requests to this url instead, e.g."
+                                " http://127.0.0.1:8000 of replay")
+
+    # worker
+    subparser = subparsers.add_parser('worker',
+                                      help="lease and run jobs of the current"
+                                           " batch job, together with other"
+                                           " workers")
+    subparser.add_argument('--fangdi', action='store_true',
+                           help="work for fangdi.com")
+    subparser.add_argument('--lianjia', action='store_true',
+                           help="work for lianjia.com")
+    subparser.add_argument('-c', '--create', action='store_true',
+                           help="create a new batch job if the last one has"
+                                " finished")
+    subparser.add_argument('--deep-check', action='store_true',
+                           help="check the result of the lianjia batch job"
+                                " by scanning the tables, instead of by the"
+                                " counters of the batch")
+    subparser.add_argument('--owner', action='store',
+                           help="name of the worker, default to"
+                                " hostname-pid-random")
+    subparser.add_argument('--base-url', action='store',
+                           default=argparse.SUPPRESS,
+                           help="send the requests to this url instead")
+
+    # replay
+    subparser = subparsers.add_parser('replay',
+                                      help="serve recorded responses as a"
+                                           " stand-in for the sites")
+    subparser.add_argument('directory',
+                           help="directory given to start --record-dir")
+    subparser.add_argument('--host', action='store', default="127.0.0.1")
+    subparser.add_argument('--port', action='store', type=int, default=8000)
+    subparser.add_argument('--latency', action='store', type=float,
+                           default=0,
+                           help="mean latency of responses in seconds")
+    subparser.add_argument('--error-rate', action='store', type=float,
+                           default=0,
+                           help="rate of 503 responses, from 0 to 1")
+    subparser.add_argument('--throughput', action='store', type=int,
+                           help="bytes per second of each response")
 
     # dump
     subparser = subparsers.add_parser('dump')
     subparser.add_argument('--fangdi', action='store_true')
     subparser.add_argument('-t', '--target', action='store', nargs='?')
 
+    # explain
+    subparser = subparsers.add_parser('explain',
+                                      help="EXPLAIN the queries of the"
+                                           " crawlers and the web api, and"
+                                           " flag full table scans")
+    subparser.add_argument('names', nargs='*', metavar='name',
+                           help="queries to explain, default to all")
+    subparser.add_argument('-v', '--verbose', action='store_true',
+                           help="print the plans of all the queries")
+
     # runserver
     subparser = subparsers.add_parser('runserver', help="run web server")
     subparser.add_argument("-D", "--daemon", action="store_true",
@@ -69,10 +155,16 @@ class Command:
             instance = Migrate()
         elif cmd_args.subcommand == "start":
             instance = Start()
+        elif cmd_args.subcommand == "worker":
+            instance = Worker()
         elif cmd_args.subcommand == "dump":
             instance = Dump()
         elif cmd_args.subcommand == "runserver":
             instance = RunServer()
+        elif cmd_args.subcommand == "replay":
+            instance = Replay()
+        elif cmd_args.subcommand == "explain":
+            instance = Explain()
 
         instance.config = config
         instance.cmd_args = cmd_args
@@ -116,25 +208,51 @@ class Migrate(SubCommand):
 
 class Start(SubCommand):
 
+    run = staticmethod(models.BatchJob.run_batch)
+
     def start(self):
+        shard = getattr(self.cmd_args, "shard", None)
+        if shard is not None and self.cmd_args.fangdi:
+            Command.subparsers.choices['start'].error(
+                "--shard only works with --lianjia")
+
         db.init(self.config, debug=self.cmd_args.debug)
         self.cmd_args.auto_commit = True
         threads = []
-        start_list = [(self.cmd_args.fangdi, models.BatchJobFD, []),
+        start_list = [(self.cmd_args.fangdi, models.BatchJobFD,
+                       ["prefetch_pages", "fd_presale_concurrency",
+                        "fd_presale_policy", "fd_presale_max_age",
+                        "fd_full_sweep_every"]),
                       (self.cmd_args.lianjia, models.BatchJobLJ,
-                       ["lj_number_per_page"])]
+                       ["lj_number_per_page", "lj_detail_concurrency",
+                        "lj_detail_policy", "lj_detail_max_age",
+                        "prefetch_pages"])]
 
         mail.send_when_batch_job_done(self.config)
+        if self.config.base_url:
+            models.set_base_url(self.config.base_url)
+        utils.rate_limiter.configure(self.config.http_rate_limit,
+                                     self.config.http_burst)
+        set_backend(self.config.parser_backend)
+        parse_pool.configure(self.config.parse_processes,
+                             self.config.parse_min_size,
+                             self.parse_cache())
+        # one connection pool shared by all the batch jobs
+        http_session = utils.HttpSession.from_config(self.config)
 
         for exist, cls, extra_params in start_list:
             if exist:
                 kwargs = {"config": copy.deepcopy(self.config),
-                          "cmd_args": copy.deepcopy(self.cmd_args)}
+                          "cmd_args": copy.deepcopy(self.cmd_args),
+                          "http_session": http_session}
                 for name in extra_params:
                     kwargs[name] = getattr(self.config, name)
+                if shard is not None:
+                    kwargs["shard"] = shard
+                kwargs.update(self.extra_kwargs())
 
-                threads.append(Thread(target=models.BatchJob.run_batch,
-                                      daemon=True, args=(cls,), kwargs=kwargs))
+                threads.append(Thread(target=self.run, daemon=True,
+                                      args=(cls,), kwargs=kwargs))
 
         for t in threads:
             t.start()
@@ -142,6 +260,43 @@ class Start(SubCommand):
         for t in threads:
             t.join()
 
+        for host, stats in utils.rate_limiter.stats().items():
+            logger.info("http statistics of %s: %s", host, stats)
+        for host, stats in http_session.pool_stats().items():
+            logger.info("http connections of %s: %s", host, stats)
+        for name, stats in parse_pool.stats().items():
+            logger.info("parse statistics of %s: %s", name, stats)
+        if parse_counters:
+            logger.info("parse counters: %s", dict(parse_counters))
+        if parse_pool.cache is not None:
+            logger.info("parse cache: %s hits, %s misses",
+                        parse_pool.cache.hits, parse_pool.cache.misses)
+        http_session.close()
+        parse_pool.shutdown()
+
+    def parse_cache(self):
+        if not self.config.parse_cache_size:
+            return None
+        directory = None
+        if self.config.parse_cache_persist:
+            directory = os.path.join(self.config.data_dir, "parse_cache")
+        return ParseCache(self.config.parse_cache_size, directory)
+
+    def extra_kwargs(self):
+        if self.cmd_args.engine == "async":
+            return {"engine": AsyncEngine(self.config.engine_concurrency,
+                                          self.config.engine_host_concurrency)}
+        else:
+            return {}
+
+
+class Worker(Start):
+
+    run = staticmethod(models.BatchJob.run_worker)
+
+    def extra_kwargs(self):
+        return {"owner": self.cmd_args.owner}
+
 
 class RunServer(SubCommand):
 
@@ -164,6 +319,56 @@ class RunServer(SubCommand):
         gunicorn.app.wsgiapp.run()
 
 
+class Replay(SubCommand):
+
+    def start(self):
+        server = ReplayServer(self.cmd_args.directory,
+                              (self.cmd_args.host, self.cmd_args.port),
+                              latency=self.cmd_args.latency,
+                              error_rate=self.cmd_args.error_rate,
+                              throughput=self.cmd_args.throughput)
+        logger.info("replay %s responses at %s",
+                    len(server.routes), server.base_url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+class Explain(SubCommand):
+
+    def start(self):
+        unknown = set(self.cmd_args.names) - set(explain.QUERIES)
+        if unknown:
+            Command.subparsers.choices['explain'].error(
+                "unknown queries: %s, choose from %s"
+                % (", ".join(sorted(unknown)),
+                   ", ".join(sorted(explain.QUERIES))))
+
+        db.init(self.config, debug=self.cmd_args.debug)
+        with db.engine.connect() as connection:
+            results = explain.explain_all(connection, self.cmd_args.names)
+
+        flagged = 0
+        for name, plan, scans in results:
+            if scans:
+                flagged += 1
+                print("%-45s FULL SCAN %s" % (name, ", ".join(scans)))
+            else:
+                print("%-45s ok" % name)
+            if scans or self.cmd_args.verbose:
+                for row in plan:
+                    print("    %s" % ", ".join("%s=%s" % item
+                                               for item in row.items()))
+
+        if flagged:
+            logger.error("%s of %s queries read a whole table",
+                         flagged, len(results))
+            sys.exit(1)
+
+
 class Dump(SubCommand):
 
     def start(self):
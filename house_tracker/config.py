@@ -52,13 +52,55 @@ class Config(metaclass=SingletonMeta):
     database = None
     db_url = None
     lj_number_per_page = 30
+    lj_detail_concurrency = 4
+    lj_detail_policy = "always"
+    lj_detail_max_age = 7
+    prefetch_pages = 2
+    fd_presale_concurrency = 4
+    fd_presale_policy = "always"
+    fd_presale_max_age = 7
+    fd_full_sweep_every = 10
+    engine_concurrency = 8
+    engine_host_concurrency = 4
+    # requests per second to each host, shared by all the jobs and threads
+    # of the process whatever the concurrency, e.g. 5 caps a batch at 5
+    # requests per second to lianjia.com. None for no limit.
+    http_rate_limit = 5
+    http_burst = 5
+    response_cache = True
+    http_pool_connections = 10
+    http_pool_maxsize = 16
+    http_keep_alive = True
+    http_connect_timeout = 3.05
+    http_read_timeout = 5
+    worker_lease_ttl = 300
+    worker_poll_interval = 10
+    parse_processes = 0
+    parse_min_size = 65536
+    parser_backend = "lxml"
+    parse_cache_size = 1024
+    parse_cache_persist = False
+    record_dir = None
+    base_url = None
     email_list = None
     smtp = None
 
     def __init__(self):
         import house_tracker_settings
         for name in ('log_file', 'log_config', 'data_dir', 'database',
-                     "lj_number_per_page", "smtp"):
+                     "lj_number_per_page", "lj_detail_concurrency",
+                     "lj_detail_policy", "lj_detail_max_age",
+                     "prefetch_pages", "fd_presale_concurrency",
+                     "fd_presale_policy", "fd_presale_max_age",
+                     "fd_full_sweep_every", "engine_concurrency",
+                     "engine_host_concurrency", "http_rate_limit",
+                     "http_burst", "response_cache", "http_pool_connections",
+                     "http_pool_maxsize", "http_keep_alive",
+                     "http_connect_timeout", "http_read_timeout",
+                     "worker_lease_ttl", "worker_poll_interval",
+                     "parse_processes", "parse_min_size", "parser_backend",
+                     "parse_cache_size", "parse_cache_persist", "record_dir",
+                     "base_url", "smtp"):
             v = getattr(house_tracker_settings, name, None)
             if v is not None:
                 setattr(self, name, v)
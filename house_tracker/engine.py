@@ -0,0 +1,87 @@
+# coding=utf-8
+
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from . import db
+from .models.base import Job, FINISHED, FAILED
+from .exceptions import BatchJobError
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncEngine:
+    """Run the jobs of a batch job concurrently in an asyncio event loop.
+
+    The crawling code is built on a blocking http session, so each job is
+    run in a thread of the executor, with a db session of its own. The event
+    loop schedules the jobs under a global limit and a limit per host. The
+    status of each job is committed by the job itself, so an interrupted
+    batch job can be resumed just like the one run by the default engine.
+    """
+
+    def __init__(self, concurrency=8, host_concurrency=4,
+                 session_factory=None):
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.session_factory = session_factory
+
+    def run(self, batch_job, jobs, **kwargs):
+        if not batch_job.auto_commit:
+            # jobs are loaded by other db sessions, they must be committed.
+            raise BatchJobError("async engine requires auto_commit")
+
+        targets = [(job.id, job.host) for job in jobs]
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            results = loop.run_until_complete(
+                self._run(loop, executor, batch_job, targets, kwargs))
+        finally:
+            executor.shutdown(wait=True)
+            loop.close()
+
+        # jobs have been updated by other db sessions
+        batch_job.db_session.expire_all()
+
+        if all(status == FINISHED for status in results):
+            return FINISHED
+        else:
+            return FAILED
+
+    async def _run(self, loop, executor, batch_job, targets, kwargs):
+        global_semaphore = asyncio.Semaphore(self.concurrency)
+        host_semaphores = {}
+
+        async def run_one(job_id, host):
+            if host not in host_semaphores:
+                host_semaphores[host] = asyncio.Semaphore(
+                                            self.host_concurrency)
+            # wait for the host first, so that a job waiting for a busy host
+            # does not occupy a global slot.
+            async with host_semaphores[host]:
+                async with global_semaphore:
+                    func = functools.partial(self._run_job, batch_job, job_id,
+                                             kwargs)
+                    return await loop.run_in_executor(executor, func)
+
+        return await asyncio.gather(*[run_one(job_id, host)
+                                      for job_id, host in targets])
+
+    def _run_job(self, batch_job, job_id, kwargs):
+        db_session = (self.session_factory or db.Session)()
+        try:
+            job = db_session.query(Job).get(job_id)
+            return batch_job.run_job(job, db_session, batch_job.http_session,
+                                     **kwargs)
+        except Exception as e:
+            # the status of the job is left as it was, and the job will be
+            # retried when the batch job is started again.
+            logger.exception(e)
+            db_session.rollback()
+            return FAILED
+        finally:
+            db_session.close()
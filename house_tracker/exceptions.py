@@ -15,6 +15,10 @@ class BatchJobError(ModelError):
     pass
 
 
+class LeaseError(ModelError):
+    pass
+
+
 class DownloadError(ModelError):
     pass
 
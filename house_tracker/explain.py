@@ -0,0 +1,225 @@
+# coding=utf-8
+"""EXPLAIN the queries issued by the crawlers and the /api/* views, and flag
+the ones reading a whole table or index.
+
+The queries are built by the same methods the code issuing them calls, with
+parameters sampled from the database. Full scans of the small tables, or of
+the ones a query reads on purpose, are expected and not flagged.
+"""
+
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, desc
+from sqlalchemy.orm import Query
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
+
+from .models import (District, Area, Community, BatchJob, CommunityLJ,
+                     HouseLJ, HouseRecordLJ, BatchJobLJ, CommunityJob,
+                     CommunityFD, PresalePermit, BatchJobFD, DistrictJob)
+
+
+# small enough to be read as a whole
+SMALL_TABLES = {"district", "area", "batch_job"}
+
+
+class Explain(Executable, ClauseElement):
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def visit_explain(element, compiler, **kwargs):
+    if compiler.dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    return prefix + compiler.process(element.statement, **kwargs)
+
+
+def full_scans(dialect_name, plan):
+    """Return the tables or indexes read as a whole in the plan."""
+    scans = []
+    for row in plan:
+        if dialect_name == "mysql":
+            if row["type"] in ("ALL", "index"):
+                scans.append(row["table"])
+        elif dialect_name == "sqlite":
+            m = re.match(r"SCAN (?:TABLE )?(\w+)", row["detail"])
+            if m is not None and "CONSTANT" not in row["detail"]:
+                scans.append(m.group(1))
+        else:
+            raise ValueError("explain is not supported for %s"
+                             % dialect_name)
+    return scans
+
+
+def sample_params(connection):
+    """Values of the parameters of the queries, taken from the last batch
+    jobs, or made up if the database is empty."""
+    params = {"batch_number": 1,
+              "community_id": 1,
+              "district_id": 1,
+              "area_id": 1,
+              "outer_ids": ["1"],
+              "begin": datetime.now() - timedelta(days=1),
+              "end": datetime.now()}
+
+    row = connection.execute(
+        select([BatchJob.batch_number, BatchJob.created_at,
+                BatchJob.last_modified_at])
+        .where(BatchJob.type == BatchJobLJ.__mapper__.polymorphic_identity)
+        .order_by(desc(BatchJob.batch_number)).limit(1)).first()
+    if row is not None:
+        params["batch_number"] = row.batch_number
+        params["begin"] = row.created_at or params["begin"]
+        params["end"] = row.last_modified_at or params["end"]
+
+    row = connection.execute(
+        select([Community.id, Community.district_id, Community.area_id,
+                Community.outer_id])
+        .where(Community.type == CommunityLJ.__mapper__.polymorphic_identity)
+        .limit(1)).first()
+    if row is not None:
+        params["community_id"] = row.id
+        params["district_id"] = row.district_id or params["district_id"]
+        params["area_id"] = row.area_id or params["area_id"]
+        params["outer_ids"] = [row.outer_id]
+    return params
+
+
+def _statement(query):
+    if isinstance(query, Query):
+        return query.with_labels().statement
+    return query
+
+
+# name: (function returning the query from the parameters, tables that
+# the query reads as a whole on purpose)
+QUERIES = {
+    # base.BatchJob
+    "BatchJob.lease_job": (
+        lambda p: BatchJobLJ.leasable_query(p["batch_number"], p["end"]),
+        ()),
+    # add_counters and the compare-and-set updates of the status use the
+    # same where clause
+    "BatchJob.get_counters": (
+        lambda p: BatchJob.counters_query(
+            p["batch_number"], BatchJobLJ.__mapper__.polymorphic_identity),
+        ()),
+
+    # lianjia
+    "BatchJobLJ.get_community_and_job": (
+        lambda p: BatchJobLJ.community_and_job_query(p["batch_number"]),
+        ("community",)),
+    "BatchJobLJ.check_result.communities": (
+        lambda p: BatchJobLJ.untracked_communities_query(p["batch_number"]),
+        ("community",)),
+    "BatchJobLJ.sum_community_records": (
+        lambda p: BatchJobLJ.sum_community_records_query(p["batch_number"]),
+        ()),
+    # --deep-check, reading the houses of all the batches on purpose
+    "BatchJobLJ.deep_check_result.records": (
+        lambda p: CommunityJob.record_number_query(p["batch_number"]),
+        ()),
+    "BatchJobLJ.deep_check_result.houses": (
+        lambda p: CommunityJob.house_numbers_query(p["batch_number"]),
+        ("house",)),
+    "CommunityJob.load_houses": (
+        lambda p: CommunityJob.houses_query(p["community_id"]),
+        ()),
+    "CommunityJob.insert_houses": (
+        lambda p: CommunityJob.house_ids_query(p["community_id"],
+                                               p["outer_ids"]),
+        ()),
+    # the updates are explained by selecting the rows they update
+    "CommunityJob.missing_houses": (
+        lambda p: CommunityJob.missing_houses_query(p["community_id"],
+                                                    p["batch_number"]),
+        ()),
+    "CommunityJob.new_and_missing": (
+        lambda p: CommunityJob.house_numbers_query(p["batch_number"],
+                                                   p["community_id"]),
+        ()),
+    "CommunityJob.community_record": (
+        lambda p: CommunityJob.community_record_query(p["community_id"],
+                                                      p["batch_number"]),
+        ()),
+
+    # fangdi
+    "BatchJobFD.get_district_and_job": (
+        lambda p: BatchJobFD.district_and_job_query(p["batch_number"]),
+        ()),
+    "BatchJobFD.mail_content.communities": (
+        lambda p: BatchJobFD.created_query(CommunityFD, p["begin"], p["end"]),
+        ()),
+    "BatchJobFD.mail_content.presales": (
+        lambda p: BatchJobFD.created_query(PresalePermit, p["begin"],
+                                           p["end"]),
+        ()),
+    "DistrictJob.communities": (
+        lambda p: DistrictJob.communities_query(p["district_id"]),
+        ()),
+    "DistrictJob.load_presales": (
+        lambda p: DistrictJob.presales_query(p["district_id"]),
+        ()),
+    "DistrictJob.insert_communities": (
+        lambda p: DistrictJob.communities_query(p["district_id"],
+                                                p["outer_ids"]),
+        ()),
+
+    # web.view, which needs flask, so that the lookups by id are rebuilt
+    # here
+    "api.district": (
+        lambda p: Query([District]),
+        ()),
+    "api.area": (
+        lambda p: Query([Area]).filter_by(district_id=p["district_id"]),
+        ()),
+    "api.community": (
+        lambda p: Query([CommunityLJ]).filter_by(area_id=p["area_id"]),
+        ()),
+    "api.avg_price.community": (
+        lambda p: HouseRecordLJ.avg_price_query(p["begin"], p["end"])
+        .where(Community.id == p["community_id"]),
+        ()),
+    "api.avg_price.area": (
+        lambda p: HouseRecordLJ.avg_price_query(p["begin"], p["end"])
+        .where(Area.id == p["area_id"]),
+        ()),
+    "api.avg_price.district": (
+        lambda p: HouseRecordLJ.avg_price_query(p["begin"], p["end"])
+        .where(District.id == p["district_id"]),
+        ()),
+    "api.avg_price.names": (
+        lambda p: select([Community.id, Community.name])
+        .where(Community.id.in_([p["community_id"]])),
+        ()),
+    "api.community_detail": (
+        lambda p: HouseLJ.available_query(
+            p["community_id"], [HouseLJ.date_to_market, HouseLJ.area,
+                                HouseLJ.price_origin, HouseLJ.price]),
+        ()),
+}
+
+
+def explain_all(connection, names=None):
+    """EXPLAIN the queries, and return a list of (name, plan, unexpected
+    full scans) in the order of the names."""
+    dialect_name = connection.dialect.name
+    params = sample_params(connection)
+
+    results = []
+    for name in names or sorted(QUERIES):
+        func_, expected = QUERIES[name]
+        rs = connection.execute(Explain(_statement(func_(params))))
+        # read the cursor, the result would be typed as the statement
+        keys = [d[0] for d in rs.cursor.description]
+        plan = [dict(zip(keys, row)) for row in rs.cursor.fetchall()]
+        rs.close()
+        scans = [t for t in full_scans(dialect_name, plan)
+                 if t not in SMALL_TABLES and t not in expected]
+        results.append((name, plan, scans))
+    return results
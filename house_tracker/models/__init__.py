@@ -4,3 +4,15 @@ from .base import PagesIterator
 from .lianjia import *
 from .fangdi import *
 from .land import *
+from .. import utils
+
+
+def set_base_url(base_url):
+    """Send the requests of all the crawlers to base_url instead, e.g. a
+    replay server."""
+    for cls, name in ((DistrictFD, "SEARCH_URL"),
+                      (CommunityFD, "PRESEIL_URL"),
+                      (CommunityFD, "COMMUNITY_URL"),
+                      (CommunityLJ, "SEARCH_URL"),
+                      (HouseLJ, "SEARCH_URL")):
+        setattr(cls, name, utils.replace_base_url(getattr(cls, name), base_url))
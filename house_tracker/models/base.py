@@ -2,19 +2,27 @@
 
 import os
 import json
+import time
+import uuid
+import socket
 import logging
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 import blinker
-from sqlalchemy import (Column, ForeignKey, types, inspect, desc,
-                        PrimaryKeyConstraint, ForeignKeyConstraint)
+from sqlalchemy import (Column, ForeignKey, types, inspect, desc, func,
+                        select, PrimaryKeyConstraint, ForeignKeyConstraint,
+                        Index)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.dialects.mysql import BINARY, VARCHAR, INTEGER, DATETIME, TEXT
-from sqlalchemy.orm import relationship, backref, joinedload
+from sqlalchemy.orm import Query, relationship, backref, joinedload
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 
-from .. import db
-from ..exceptions import JobError, BatchJobError, ParseError, DownloadError
+from .. import db, utils
+from ..utils.cache import CachedSession, ResponseCache
+from ..exceptions import (JobError, BatchJobError, ParseError, DownloadError,
+                          LeaseError)
 
 
 logger = logging.getLogger(__name__)
@@ -118,6 +126,14 @@ class Community(Base, IdMixin):
     """记录小区，包括已建成小区和在售楼盘"""
     __tablename__ = 'community'
 
+    __table_args__ = (
+        Index('ix_community_type_outer_id', 'type', 'outer_id'),
+        Index('ix_community_district_id', 'district_id'),
+        Index('ix_community_area_id', 'area_id'),
+        Index('ix_community_created_at', 'created_at'),
+        Base.__table_args__
+    )
+
     district_id = Column(INTEGER, ForeignKey("district.id"))
     area_id = Column(INTEGER, ForeignKey('area.id'))
     outer_id = Column(VARCHAR(128))
@@ -147,6 +163,12 @@ class BatchJob(Base, StatusMixin, SessionMixin):
     batch_number = Column(INTEGER, nullable=False)
     type = Column(BINARY(8), nullable=False)
 
+    # counters added by the jobs when they finish, see add_counters
+    record_number = Column(INTEGER, default=0)
+    available_number = Column(INTEGER, default=0)
+    new_number = Column(INTEGER, default=0)
+    missing_number = Column(INTEGER, default=0)
+
     # jobs = relationship(Job)
 
     jobs_unfinished = relationship(
@@ -166,26 +188,44 @@ class BatchJob(Base, StatusMixin, SessionMixin):
     )
 
     cache_dir = None
+    engine = None
+    # check the result by scanning the tables instead of by the counters
+    deep_check = False
+    # the status when the batch job is started, see set_status
+    started_status = None
 
     def __init__(self, batch_number):
         self.batch_number = batch_number
         self.status = READY
 
     def start(self, db_session, http_session, auto_commit=True, cache_dir=None,
-              **kwargs):
+              engine=None, response_cache=True, **kwargs):
         """This method do not catch JobError, because base class doesn't know
-        how to deal with the error. JobError is cached in _start method."""
+        how to deal with the error. JobError is cached in _start method.
 
-        self.prepare_dir(cache_dir)
-        self.prepare_session(db_session, http_session, auto_commit)
+        If response_cache is True, responses are saved into the cache dir,
+        so that they are replayed from disk when the batch job is restarted.
+        """
+
+        self.engine = engine
+        self.started_status = self.status
+        self.prepare(db_session, http_session, auto_commit, cache_dir,
+                     response_cache)
 
         for job in self.jobs_unfinished:
             if job.status not in (READY, RETRY):
                 job.status = RETRY
         self.commit()
 
-        self.status = self._start(**kwargs)
-        self.commit()
+        self.set_status(self._start(**kwargs))
+
+    def prepare(self, db_session, http_session, auto_commit=True,
+                cache_dir=None, response_cache=True):
+        self.prepare_dir(cache_dir)
+        if response_cache:
+            http_session = CachedSession(http_session,
+                                         ResponseCache(self.cache_dir))
+        self.prepare_session(db_session, http_session, auto_commit)
 
     def prepare_dir(self, root):
         if root is None:
@@ -196,25 +236,34 @@ class BatchJob(Base, StatusMixin, SessionMixin):
 
     @staticmethod
     def run_batch(cls, config=None, cmd_args=None, db_session=None,
-                  auto_commit=True, **kwargs):
+                  auto_commit=True, http_session=None, **kwargs):
 
         db_session = db_session or db.Session()
-        http_session = requests.Session()
-        batch_job = BatchJob.get_batch_job(cls, db_session,
-                                           create=cmd_args.create,
-                                           force=cmd_args.force)
+        http_session = http_session or utils.HttpSession.from_config(config)
+        if kwargs.get("shard") is None:
+            batch_job = BatchJob.get_batch_job(cls, db_session,
+                                               create=cmd_args.create,
+                                               force=cmd_args.force)
+        else:
+            # the shards run the same batch job
+            batch_job = BatchJob.get_batch_job(cls, db_session,
+                                               create=cmd_args.create,
+                                               join=True)
 
         if not batch_job:
             return
         elif batch_job.status == FINISHED:
             logger.info("the last batch job has already finished.")
             return
+        batch_job.deep_check = getattr(cmd_args, "deep_check", False)
+        # for set_status if failed before preparing
+        batch_job.prepare_session(db_session, http_session, auto_commit)
 
         try:
             logger.info("batch job start...")
             batch_job.start(db_session, http_session,
                             cache_dir=config.data_dir, auto_commit=auto_commit,
-                            **kwargs)
+                            response_cache=config.response_cache, **kwargs)
             logger.info("batch job finished")
         except BatchJobError as e:
             # all objects' status should have been already set
@@ -226,17 +275,26 @@ class BatchJob(Base, StatusMixin, SessionMixin):
             logger.exception(e)
             db_session.rollback()
             logger.warning("run_batch rollback")
-            batch_job.status = FAILED
+            batch_job.set_status(FAILED)
 
         if auto_commit:
             db_session.commit()
 
+        cache = getattr(batch_job.http_session, "response_cache", None)
+        if cache is not None:
+            logger.info("response cache: %s hits, %s misses",
+                        cache.hits, cache.misses)
+
         sig_batch_job_done.send(batch_job)
 
         return batch_job
 
     @staticmethod
-    def get_batch_job(cls, db_session, create=False, force=False):
+    def get_batch_job(cls, db_session, create=False, force=False, join=False):
+        """Return the last batch job, or a new one if create is True and
+        the last one has finished. If join is True, an unfinished last batch
+        job is returned instead of nothing, so that it can be run together
+        with other processes."""
 
         last_batch_job = (db_session.query(cls)
                           .options(joinedload('jobs_unfinished'))
@@ -248,40 +306,304 @@ class BatchJob(Base, StatusMixin, SessionMixin):
                 logger.info("no unfinished batch job found.")
                 return
             else:
-                current_batch_job = cls(1)
-                db_session.add(current_batch_job)
-                db_session.flush()
+                current_batch_job = BatchJob._create(cls, db_session, 1)
         else:
             if not create:
                 current_batch_job = last_batch_job
             else:
                 if last_batch_job.status == FINISHED or force:
-                    current_batch_job = cls(last_batch_job.batch_number+1)
-                    db_session.add(current_batch_job)
-                    db_session.flush()
+                    current_batch_job = BatchJob._create(
+                        cls, db_session, last_batch_job.batch_number+1)
+                elif join:
+                    current_batch_job = last_batch_job
                 else:
                     logger.info('last batch not finished yet.')
                     return
 
         return current_batch_job
 
-    def _get_obj_and_job(self, obj_cls, job_cls, on_foreign, filter_=None,
-                         order=None):
-        query = (self.db_session.query(obj_cls, job_cls)
+    @staticmethod
+    def _create(cls, db_session, batch_number):
+        """Create the batch job. If another process has created it at the
+        same time, the primary key conflicts, and that one is returned."""
+        batch_job = cls(batch_number)
+        db_session.add(batch_job)
+        try:
+            db_session.flush()
+        except IntegrityError:
+            db_session.rollback()
+            logger.info("batch job %s has been created by another process.",
+                        batch_number)
+            batch_job = (db_session.query(cls)
+                         .filter_by(batch_number=batch_number)
+                         .one())
+        return batch_job
+
+    @staticmethod
+    def run_worker(cls, config=None, cmd_args=None, db_session=None,
+                   http_session=None, owner=None, **kwargs):
+        """Lease and run the jobs of the current batch job until none is
+        left. Any number of workers, in one or more processes or hosts, can
+        work on the same batch job. The lease of a job is kept alive by a
+        heartbeat, and the job can be leased by another worker once the
+        lease expires. The status of the batch job is set by the worker
+        that finds all the jobs done."""
+
+        db_session = db_session or db.Session()
+        http_session = http_session or utils.HttpSession.from_config(config)
+        owner = owner or "%s-%s-%s" % (socket.gethostname(), os.getpid(),
+                                       uuid.uuid4().hex[:8])
+        ttl = timedelta(seconds=config.worker_lease_ttl)
+
+        batch_job = BatchJob.get_batch_job(cls, db_session,
+                                           create=cmd_args.create, join=True)
+        if not batch_job:
+            return
+        elif batch_job.status == FINISHED:
+            logger.info("the last batch job has already finished.")
+            return
+        batch_job.deep_check = getattr(cmd_args, "deep_check", False)
+
+        logger.info("worker %s start...", owner)
+        batch_job.prepare(db_session, http_session, auto_commit=True,
+                          cache_dir=config.data_dir,
+                          response_cache=config.response_cache)
+        batch_job.prepare_jobs()
+
+        while True:
+            job = batch_job.lease_job(owner, ttl)
+            if job is None:
+                if batch_job.count_jobs(READY, RETRY) == 0:
+                    break
+                # the rest are leased by other workers, wait in case some
+                # of the leases expire.
+                time.sleep(config.worker_poll_interval)
+                continue
+
+            with JobLease(db_session.get_bind(), job.id, owner, ttl) as lease:
+                job.lease = lease
+                try:
+                    batch_job.run_job(job, db_session, batch_job.http_session,
+                                      **kwargs)
+                except LeaseError as e:
+                    # the job is run by the new owner of the lease, leave
+                    # it untouched
+                    logger.error(e)
+                    db_session.rollback()
+                except (InterruptedError, Exception) as e:
+                    logger.exception(e)
+                    db_session.rollback()
+                    job.status = FAILED
+                    job.commit()
+
+        if batch_job.finish_jobs():
+            logger.info("worker %s finished the batch job: %s",
+                        owner, batch_job.status)
+            sig_batch_job_done.send(batch_job)
+        else:
+            logger.info("worker %s finished", owner)
+
+        return batch_job
+
+    def prepare_jobs(self):
+        """Create the missing jobs, holding a lock on the batch job row so
+        that workers do not create the same job twice. Failed jobs of a
+        failed batch job are retried."""
+        (self.db_session.query(BatchJob)
+         .filter_by(batch_number=self.batch_number, type=self.type)
+         .with_for_update()
+         .one())
+        self.db_session.refresh(self)
+
+        if self.status == FAILED:
+            self.status = READY
+            (self.db_session.query(Job)
+             .filter_by(batch_number=self.batch_number, batch_type=self.type,
+                        status=FAILED)
+             .update({Job.status: RETRY}, synchronize_session=False))
+
+        self.get_jobs()
+        # release the lock
+        self.commit()
+
+    def get_jobs(self):
+        """Return the unfinished jobs, creating the missing ones."""
+        return []
+
+    def lease_job(self, owner, ttl):
+        """Lease one of the jobs that are ready and not leased by others.
+        The lease is taken by an atomic update, which succeeds for only
+        one worker."""
+        now = datetime.now()
+        table = Job.__table__
+        leasable = self.leasable(self.batch_number, now)
+
+        query = self.leasable_query(self.batch_number, now)
+        for row in self.db_session.execute(query).fetchall():
+            rs = self.db_session.execute(
+                    table.update()
+                    .where(leasable & (table.c.id == row.id))
+                    .values(lease_owner=owner, lease_expires_at=now + ttl,
+                            heartbeat_at=now))
+            self.db_session.commit()
+            if rs.rowcount == 1:
+                return self.db_session.query(Job).get(row.id)
+
+        return None
+
+    @classmethod
+    def leasable(cls, batch_number, now):
+        """Return the condition of the jobs of the batch that can be
+        leased at now."""
+        table = Job.__table__
+        return ((table.c.batch_number == batch_number)
+                & (table.c.batch_type == cls.__mapper__.polymorphic_identity)
+                & table.c.status.in_([READY, RETRY])
+                & (table.c.lease_owner.is_(None)
+                   | (table.c.lease_expires_at < now)))
+
+    @classmethod
+    def leasable_query(cls, batch_number, now):
+        table = Job.__table__
+        return (select([table.c.id]).where(cls.leasable(batch_number, now))
+                .order_by(table.c.id))
+
+    @staticmethod
+    def batch_filter(batch_number, batch_type):
+        """Return the condition of the row of a batch job."""
+        table = BatchJob.__table__
+        return ((table.c.batch_number == batch_number)
+                & (table.c.type == batch_type))
+
+    def count_jobs(self, *statuses):
+        return (self.db_session.query(func.count(Job.id))
+                .filter_by(batch_number=self.batch_number,
+                           batch_type=self.type)
+                .filter(Job.status.in_(statuses))
+                .scalar())
+
+    def finish_jobs(self):
+        """Set the status of the batch job when all the jobs are done.
+        Return False if another worker has already done it."""
+        old_status = self.status
+        if self.count_jobs(FAILED) > 0:
+            result = FAILED
+        else:
+            result = self.check_result()
+
+        table = BatchJob.__table__
+        rs = self.db_session.execute(
+                table.update()
+                .where(self.batch_filter(self.batch_number, self.type)
+                       & (table.c.status == old_status))
+                .values(status=result))
+        self.db_session.commit()
+        self.db_session.refresh(self)
+        return rs.rowcount == 1
+
+    def check_result(self):
+        return FINISHED
+
+    def set_status(self, status):
+        """Set the status by a compare-and-set update, like finish_jobs.
+        The update is done only if the status is still the one when the
+        batch job was started, or RUNNING, so that a result set by another
+        process running the same batch job, e.g. another shard, is never
+        overwritten. Return False if it is not done."""
+        old_statuses = {self.started_status or self.status, RUNNING}
+        table = BatchJob.__table__
+        rs = self.db_session.execute(
+                table.update()
+                .where(self.batch_filter(self.batch_number, self.type)
+                       & table.c.status.in_(old_statuses))
+                .values(status=status))
+        self.commit()
+        self.db_session.refresh(self)
+        if rs.rowcount != 1:
+            logger.info("status %s of the batch job is not set, it has been"
+                        " set to %s by another process", status, self.status)
+        return rs.rowcount == 1
+
+    @staticmethod
+    def add_counters(db_session, batch_number, batch_type, **counters):
+        """Add to the counters of a batch job by an atomic update, so that
+        the jobs run by different workers can add to them at the same
+        time. It is done in the transaction of the job, and the counters
+        are committed together with the status of the job."""
+        table = BatchJob.__table__
+        values = {name: func.coalesce(table.c[name], 0) + number
+                  for name, number in counters.items()}
+        db_session.execute(table.update()
+                           .where(BatchJob.batch_filter(batch_number,
+                                                        batch_type))
+                           .values(values))
+
+    def get_counters(self):
+        """Return the counters of the batch job in the db, as a dict."""
+        query = self.counters_query(self.batch_number, self.type)
+        return dict(self.db_session.execute(query).first().items())
+
+    @staticmethod
+    def counters_query(batch_number, batch_type):
+        table = BatchJob.__table__
+        names = ("record_number", "available_number", "new_number",
+                 "missing_number")
+        return (select([func.coalesce(table.c[name], 0).label(name)
+                        for name in names])
+                .where(BatchJob.batch_filter(batch_number, batch_type)))
+
+    @classmethod
+    def obj_and_job_query(cls, batch_number, obj_cls, job_cls, on_foreign,
+                          filter_=None, order=None):
+        """Return the query of the objects outer joined with their jobs of
+        the batch. It is not bound to a session."""
+        batch_type = cls.__mapper__.polymorphic_identity
+        query = (Query([obj_cls, job_cls])
                  .outerjoin(job_cls,
                             on_foreign
-                            & (job_cls.batch_number == self.batch_number)
-                            & (job_cls.batch_type == self.type)))
+                            & (job_cls.batch_number == batch_number)
+                            & (job_cls.batch_type == batch_type)))
         if filter_ is not None:
             query = query.filter(filter_)
         if order is not None:
             query = query.order_by(order)
-        return query.all()
+        return query
 
     def _start(self, **kwargs):
         """This method should catch JobError and deal with it appropriately."""
         return FINISHED
 
+    def run_jobs(self, jobs, **kwargs):
+        """Run the jobs by the engine if there is one, otherwise one by one.
+        Return FINISHED only if all the jobs finished."""
+
+        if self.engine is not None:
+            return self.engine.run(self, jobs, **kwargs)
+
+        result = FINISHED
+        for job in jobs:
+            status = self.run_job(job, self.db_session, self.http_session,
+                                  **kwargs)
+            if status != FINISHED:
+                result = FAILED
+        return result
+
+    def run_job(self, job, db_session, http_session, **kwargs):
+        """Start the job and catch JobError. Sessions are passed in because
+        an engine may run the job with sessions other than the batch job's.
+        """
+        logger.info("%s start, id: %s", job.type, job.id)
+        try:
+            job.start(db_session, http_session, auto_commit=self.auto_commit,
+                      **kwargs)
+        except JobError as e:
+            logger.error("%s of id %s failed: %s",
+                         job.__class__.__name__, job.id, e)
+            job.status = FAILED
+            job.commit()
+
+        return job.status
+
     def __str__(self):
         bt = self.type.decode().replace("\0", "")
         content = "%s %s 第 %s 次搜索，" % (
@@ -311,14 +633,24 @@ class Job(Base, IdMixin, StatusMixin, SessionMixin):
     parameters = Column(PickleType)
     type = Column(VARCHAR(16))
 
+    # lease of a worker, see BatchJob.run_worker
+    lease_owner = Column(VARCHAR(64))
+    lease_expires_at = Column(DATETIME)
+    heartbeat_at = Column(DATETIME)
+
     batch_job = relationship(BatchJob, backref=backref('jobs'))
 
+    # the JobLease of the worker running the job, if any
+    lease = None
+
     __mapper_args__ = {
         'polymorphic_on': type,
         'polymorphic_identity': 'job',
     }
 
     __table_args__ = (
+        Index('ix_job_batch_number_batch_type_status',
+              'batch_number', 'batch_type', 'status'),
         ForeignKeyConstraint(('batch_number', 'batch_type'),
                              ('batch_job.batch_number', 'batch_job.type')),
         Base.__table_args__
@@ -330,6 +662,12 @@ class Job(Base, IdMixin, StatusMixin, SessionMixin):
                       batch_type=batch_job.type)
         self.parameters = parameters or {}
 
+    @property
+    def host(self):
+        """The host this job sends requests to, used by the engine to limit
+        concurrency per host."""
+        return None
+
     def start(self, db_session, http_session, auto_commit=True,
               **kwargs):
 
@@ -338,7 +676,10 @@ class Job(Base, IdMixin, StatusMixin, SessionMixin):
             raise JobError("can not start job in status '%s', id: %s"
                            % (self.status, self.id))
 
-        self.status = self._start(**kwargs)
+        status = self._start(**kwargs)
+        if self.lease is not None:
+            self.lease.check()
+        self.status = status
         self.commit()
 
     def _start(self, **kwargs):
@@ -347,41 +688,60 @@ class Job(Base, IdMixin, StatusMixin, SessionMixin):
         """
         return FINISHED
 
-    def get_web_page(self, cache=False):
-        """get the content of target web page. Load from disk if already cached.
-        """
-        # try to get cached file
-        path = self.cache_file_path
-        if path and os.path.isfile(path):
-            logger.info('%s -> %s.', self.web_uri(), path)
-            return self.load_from_disk()
-
-            # get from web
-        if cache and not path:
-            logger.error('get cache file path failed.')
-            raise JobError
-        else:
-            return self.load_from_web(cache)
-
-    def load_from_disk(self):
-        file_path = self.cache_file_path
-
-        if not self.target_uri:
-            self.target_uri = file_path
 
-        with open(file_path, 'rb') as f:
-            content = f.read().decode('utf-8')
+class JobLease:
+    """Renew the lease of a job in a background thread while the job is
+    running. The lease is taken by the worker with BatchJob.lease_job.
 
-        self.use_cached = True
+    If a renewal finds the lease taken by another worker, e.g. after a
+    pause longer than the ttl, lost is set, and check raises LeaseError to
+    stop the job between pages.
+    """
 
-        return content
+    def __init__(self, bind, job_id, owner, ttl):
+        self.bind = bind
+        self.job_id = job_id
+        self.owner = owner
+        self.ttl = ttl
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
 
-    def disk_uri(self):
-        return '%s-%s-%s' % (self.batch_number, self.type, self.id)
+    def __enter__(self):
+        self.thread.start()
+        return self
 
-    @property
-    def cache_path(self):
-        return os.path.join(self.batch_job.cache_dir, self.disk_uri())
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+        # release the lease
+        self.renew(timedelta(0))
+
+    def renew(self, ttl):
+        now = datetime.now()
+        table = Job.__table__
+        with self.bind.begin() as conn:
+            rs = conn.execute(table.update()
+                              .where((table.c.id == self.job_id)
+                                     & (table.c.lease_owner == self.owner))
+                              .values(lease_expires_at=now + ttl,
+                                      heartbeat_at=now))
+        return rs.rowcount == 1
+
+    def check(self):
+        if self.lost.is_set():
+            raise LeaseError("lease of job %s is lost by %s"
+                             % (self.job_id, self.owner))
+
+    def _run(self):
+        while not self.stopped.wait(self.ttl.total_seconds() / 3):
+            try:
+                if not self.renew(self.ttl):
+                    logger.error("lease of job %s is lost", self.job_id)
+                    self.lost.set()
+                    return
+            except Exception as e:
+                logger.exception(e)
 
 
 class JobWithCommunity(Job):
@@ -401,26 +761,51 @@ class JobWithCommunity(Job):
 
 
 class PagesIterator:
+    """Iterate over the pages of a search, and save the progress into
+    job.parameters for resuming.
+
+    If prefetch > 0, once the total page is known, the next pages are
+    downloaded in background threads while the current one is processed.
+    In that case search_func must be safe to be called out of the thread
+    owning the db session. Pages are always returned in order.
 
-    def __init__(self, job, search_func):
+    If the job is run under a JobLease that is lost, LeaseError is raised
+    instead of the next page.
+    """
+
+    def __init__(self, job, search_func, prefetch=0):
         self.job = job
         self.search_func = search_func
         self.total_page = job.parameters.get("total_page", None)
         self.next_page = job.parameters.get("next_page", 1)
         self.http_session = job.http_session
         self.params = {}
+        self.prefetch = prefetch or 0
+        self.executor = None
+        self.futures = {}
 
     def __iter__(self):
         return self
 
     def __next__(self):
         if self.total_page is not None and self.next_page > self.total_page:
+            self.close()
             raise StopIteration
 
+        lease = getattr(self.job, "lease", None)
+        if lease is not None:
+            try:
+                lease.check()
+            except LeaseError:
+                self.close()
+                raise
+
+        self._prefetch()
         try:
-            content = self.search_func(self.http_session, self.next_page)
+            content = self._get_page(self.next_page)
         except (ParseError, DownloadError) as e:
             # if failed, stop immediately
+            self.close()
             raise JobError("%s: %s" % (e.__class__.__name__, e))
 
         if self.total_page is None:
@@ -431,8 +816,45 @@ class PagesIterator:
         self.params["next_page"] = self.next_page = self.next_page + 1
         self.job.parameters = self.params
 
+        self._prefetch()
         return content
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures = {}
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def _get_page(self, page):
+        future = self.futures.pop(page, None)
+        if future is None:
+            return self.search_func(self.http_session, page)
+        else:
+            return future.result()
+
+    def _prefetch(self):
+        if not self.prefetch or self.total_page is None:
+            return
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.prefetch)
+
+        # the next page and the ones after it, prefetch pages in all
+        last_page = min(self.next_page + self.prefetch - 1, self.total_page)
+        for page in range(self.next_page, last_page + 1):
+            if page not in self.futures:
+                self.futures[page] = self.executor.submit(
+                                        self.search_func, self.http_session,
+                                        page)
+
 
 __all__ = [key for key in list(globals().keys())
            if isinstance(globals()[key], DeclarativeMeta)]
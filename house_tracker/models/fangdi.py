@@ -4,25 +4,38 @@ import re
 import codecs
 import random
 import logging
+import functools
 import urllib.parse
 from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from bs4 import BeautifulSoup
-from sqlalchemy import Column, ForeignKey
+from sqlalchemy import Column, ForeignKey, Index, select
 from sqlalchemy.dialects.mysql import VARCHAR, INTEGER, BOOLEAN, FLOAT, DATE
-from sqlalchemy.orm import relationship, backref, joinedload
+from sqlalchemy.orm import Query, relationship, backref, joinedload
 from requests import Request
 
 from . import base
 from .base import (District, Community, IdMixin, Base, BatchJob, Job,
                    PagesIterator)
 from .. import utils
+from ..utils.parser import parse_pool, parse_html, parser_version
 from ..exceptions import JobError, ParseError, DownloadError
 
 
 logger = logging.getLogger(__name__)
 ENCODING = "gbk"
 
+# policies to check the presale permits of communities
+POLICY_ALWAYS = "always"
+POLICY_INCREMENTAL = "incremental"
+
+# why the presale permits of a community are checked
+PRESALE_ALWAYS = "always"
+PRESALE_SWEEP = "sweep"
+PRESALE_NEW = "new"
+PRESALE_CHANGED = "changed"
+PRESALE_STALE = "stale"
+
 
 class DistrictFD(District):
 
@@ -31,14 +44,26 @@ class DistrictFD(District):
     SEARCH_URL = "http://www.fangdi.com.cn/complexpro.asp"
 
     def fd_search(self, http_session, page):
-        req = self._fd_search_request(page)
+        return self._fd_search(self.outer_id, self.name, http_session, page)
+
+    def fd_search_func(self):
+        """Return a search function that holds no reference to this object,
+        so it is safe to be called out of the thread owning the db session.
+        """
+        return functools.partial(self._fd_search, self.outer_id, self.name)
+
+    @classmethod
+    def _fd_search(cls, outer_id, name, http_session, page):
+        req = cls._fd_search_request(outer_id, page)
         resp = utils.do_http_request(http_session, req, timeout=10)
         resp.encoding = ENCODING
-        return self._fd_parse(resp, page)
+        with utils.evict_on_error(http_session, resp):
+            return parse_pool.parse(cls._fd_parse, resp, page, name)
 
-    def _fd_search_request(self, page):
+    @classmethod
+    def _fd_search_request(cls, outer_id, page):
         params = {"page": page,
-                  "districtID": self.outer_id,
+                  "districtID": outer_id,
                   "Region_ID": "",
                   "projectAdr": "",
                   "projectName": "",
@@ -48,9 +73,11 @@ class DistrictFD(District):
                   "averagePrice": 0,
                   "selState": "",
                   "selCircle": 0}
-        return Request(url=DistrictFD.SEARCH_URL, method="GET", params=params)
+        return Request(url=cls.SEARCH_URL, method="GET", params=params)
 
-    def _fd_parse(self, resp, page):
+    @staticmethod
+    @parser_version(1)
+    def _fd_parse(resp, page, name):
         """The html page has the following skeleton:
         <HTML>...<body>
             ...
@@ -79,12 +106,12 @@ class DistrictFD(District):
             </table>
         </body></html>
         """
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        doc = parse_html(resp.text)
         community_list = []
 
-        for table in soup.find_all('table'):
-            target_cols = table.tr.find_all('td', string=['项目地址', '所在区县'],
-                                            recursive=False)
+        for table in doc.find_all('table'):
+            target_cols = table.find('tr').find_all('td', recursive=False,
+                                                    string=['项目地址', '所在区县'])
             if len(target_cols) == 2:
                 break
         else:
@@ -97,26 +124,25 @@ class DistrictFD(District):
                 continue
             tds = row.find_all('td', recursive=False)
 
-            if self.name != tds[5].string:
+            if name != tds[5].string:
                 raise ParseError("request fangdi.com.cn district page with name"
                                  " %s, but get page with name %s: %s" %
-                                 (self.name, tds[5].string, resp.url))
+                                 (name, tds[5].string, resp.url))
 
-            href = urllib.parse.urlparse(tds[1].a["href"])
+            href = urllib.parse.urlparse(tds[1].find('a')["href"])
             project_id = urllib.parse.parse_qs(href.query)["projectID"][0]
             outer_id = CommunityFD.fd_decode_project_id(project_id)
 
             c_info = {'outer_id': outer_id,
-                      'name': tds[1].get_text(),
+                      'name': tds[1].text,
                       'location': tds[2].string,
                       'total_number': int(tds[3].string),
                       'total_area': float(tds[4].string)}
             community_list.append(c_info)
 
         # parse page number
-        sub_table = table.table
-        result = re.search("第(\d+)页/共(\d+)页",
-                           sub_table.tr.td.td.get_text())
+        sub_table = table.find('table')
+        result = re.search("第(\d+)页/共(\d+)页", sub_table.text)
         current_page = int(result.group(1))
         total_page = int(result.group(2))
         if current_page != page:
@@ -142,6 +168,8 @@ class CommunityFD(Community):
     company = Column(VARCHAR(1024))
     track_presale = Column(BOOLEAN)
     presale_url_name = Column(VARCHAR(1024))
+    # the last batch that checked the presale permits
+    presale_batch_number = Column(INTEGER)
     # presales = relationship('PresalePermit')
 
     district = relationship(DistrictFD, foreign_keys=Community.district_id)
@@ -160,58 +188,149 @@ class CommunityFD(Community):
                 setattr(self, key, kwargs[key])
         self.track_presale = True
 
+    def presale_reason(self, batch_number, c_info, policy=None, max_age=None,
+                       sweep_every=None):
+        """Return the reason why the presale permits should be checked under
+        the policy, or None if it can be skipped. c_info is the row of the
+        community in the district listing."""
+        if policy is None or policy == POLICY_ALWAYS:
+            return PRESALE_ALWAYS
+        elif policy != POLICY_INCREMENTAL:
+            raise ValueError("unknown presale policy: %s" % policy)
+
+        if sweep_every and batch_number % sweep_every == 0:
+            return PRESALE_SWEEP
+        elif self.presale_batch_number is None:
+            return PRESALE_NEW
+        elif self.listing_changed(c_info):
+            return PRESALE_CHANGED
+        elif max_age and batch_number - self.presale_batch_number >= max_age:
+            return PRESALE_STALE
+        else:
+            return None
+
+    def listing_changed(self, c_info):
+        if c_info.get("total_number") != self.total_number:
+            return True
+        # total_area is stored as a single precision float
+        total_area = c_info.get("total_area")
+        if total_area is None or self.total_area is None:
+            return total_area != self.total_area
+        return abs(total_area - self.total_area) > 0.01
+
     def load_detail(self, http_session):
-        resp = utils.do_http_request(http_session, self._fd_community_request(),
-                                     timeout=10)
-        resp.encoding = ENCODING
-        c_info = self._fd_parse_community(resp)
+        self.update_detail(self._fd_search_detail(self.outer_id, http_session))
+
+    def update_detail(self, c_info):
         self.company = c_info["company"]
         self.presale_url_name = c_info["presale_url_name"]
 
     def fd_search_presale(self, http_session):
-        resp = utils.do_http_request(http_session, self._fd_presale_request(),
-                                     timeout=10)
-        resp.encoding = ENCODING
-        return self._fd_parse_presale(resp)
-
-    def check_presale_permit(self, db_session, http_session):
-
-        if self.presale_url_name is None:
-            self.load_detail(http_session)
-
-        presales = self.fd_search_presale(http_session)
-        old_presales = set(p.serial_number for p in self.presales)
+        return self._fd_search_presale(self.id, self.outer_id,
+                                       self.presale_url_name, http_session)
+
+    def check_presale_permit(self, db_session, http_session,
+                             known_presales=None):
+        c_info, presales = self.fd_check_func()(http_session)
+        self.update_presale_permit(db_session, c_info, presales,
+                                   known_presales)
+
+    def fd_check_func(self):
+        """Return a function downloading and parsing the pages needed by
+        check_presale_permit. It holds no reference to this object, so it is
+        safe to be called out of the thread owning the db session.
+        """
+        return functools.partial(self._fd_check, self.id, self.outer_id,
+                                 self.presale_url_name)
+
+    def update_presale_permit(self, db_session, c_info, presales,
+                              known_presales=None):
+        """Add the presale permits not saved yet. known_presales is a set of
+        (community_id, serial_number) of the saved permits, see
+        DistrictJob.load_presales, which saves loading the permits of the
+        community. The added ones are put into it."""
+        if c_info is not None:
+            self.update_detail(c_info)
+
+        if known_presales is None:
+            known_presales = set((self.id, p.serial_number)
+                                 for p in self.presales)
 
         for presale_info in presales:
-            if not presale_info['serial_number'] in old_presales:
+            key = (self.id, presale_info['serial_number'])
+            if key not in known_presales:
                 db_session.add(PresalePermit(self, **presale_info))
+                known_presales.add(key)
+
+    @classmethod
+    def _fd_check(cls, community_id, outer_id, presale_url_name, http_session):
+        c_info = None
+        if presale_url_name is None:
+            c_info = cls._fd_search_detail(outer_id, http_session)
+            presale_url_name = c_info["presale_url_name"]
+
+        presales = cls._fd_search_presale(community_id, outer_id,
+                                          presale_url_name, http_session)
+        return c_info, presales
+
+    @classmethod
+    def _fd_search_detail(cls, outer_id, http_session):
+        resp = utils.do_http_request(http_session,
+                                     cls._fd_community_request(outer_id),
+                                     timeout=10,
+                                     cache_key=cls._fd_cache_key(
+                                         cls.COMMUNITY_URL, outer_id))
+        resp.encoding = ENCODING
+        with utils.evict_on_error(http_session, resp):
+            return parse_pool.parse(cls._fd_parse_community, resp, outer_id)
+
+    @classmethod
+    def _fd_search_presale(cls, community_id, outer_id, presale_url_name,
+                           http_session):
+        req = cls._fd_presale_request(community_id, outer_id, presale_url_name)
+        resp = utils.do_http_request(http_session, req,
+                                     timeout=10,
+                                     cache_key=cls._fd_cache_key(
+                                         cls.PRESEIL_URL, outer_id))
+        resp.encoding = ENCODING
+        with utils.evict_on_error(http_session, resp):
+            return parse_pool.parse(cls._fd_parse_presale, resp, community_id)
 
     @staticmethod
     def fd_decode_project_id(content):
         return codecs.decode(bytes(content, "ascii"), "base64"
                              ).decode('ascii').split('|')[0]
 
-    def _fd_presale_request(self):
-        if self.presale_url_name is None:
+    @classmethod
+    def _fd_presale_request(cls, community_id, outer_id, presale_url_name):
+        if presale_url_name is None:
             raise DownloadError("presale_url_name not exist: community id = %s"
-                                % self.id)
-        project_name = self.presale_url_name.encode(ENCODING)
-        params = {"projectID": self._tmp_id,
+                                % community_id)
+        project_name = presale_url_name.encode(ENCODING)
+        params = {"projectID": cls._fd_tmp_id(outer_id),
                   "projectname": project_name}
-        return Request(url=CommunityFD.PRESEIL_URL, method="GET", params=params)
+        return Request(url=cls.PRESEIL_URL, method="GET", params=params)
 
-    def _fd_community_request(self):
-        return Request(url=CommunityFD.COMMUNITY_URL, method="GET",
-                       params={"projectID": self._tmp_id})
+    @classmethod
+    def _fd_community_request(cls, outer_id):
+        return Request(url=cls.COMMUNITY_URL, method="GET",
+                       params={"projectID": cls._fd_tmp_id(outer_id)})
 
-    @property
-    def _tmp_id(self):
+    @staticmethod
+    def _fd_cache_key(url, outer_id):
+        # projectID in the url changes every time, see _fd_tmp_id
+        return "%s?outer_id=%s" % (url, outer_id)
+
+    @staticmethod
+    def _fd_tmp_id(outer_id):
         today = date.today().isoformat().replace('-0', '-')
         tail = random.randint(1, 99)
-        tmp_id = bytes('%s|%s|%s' % (self.outer_id, today, tail), 'ascii')
+        tmp_id = bytes('%s|%s|%s' % (outer_id, today, tail), 'ascii')
         return codecs.encode(tmp_id, "base64").strip().decode("ascii")
 
-    def _fd_parse_presale(self, resp):
+    @staticmethod
+    @parser_version(1)
+    def _fd_parse_presale(resp, community_id):
         """The html page has the following skeleton:
         <html>
         ...
@@ -232,10 +351,10 @@ class CommunityFD(Community):
         ...
         </html>
         """
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        table = soup.table
-        test_cols = table.tr.find_all('td', string=['开盘日期', '总套数'],
-                                      recursive=False)
+        doc = parse_html(resp.text)
+        table = doc.find('table')
+        test_cols = table.find('tr').find_all('td', recursive=False,
+                                              string=['开盘日期', '总套数'])
         if len(test_cols) != 2:
             raise ParseError("can not find target content of fangdi.com.cn"
                              " presale page: %s" % resp.url)
@@ -246,34 +365,34 @@ class CommunityFD(Community):
                 continue
             tds = row.find_all('td', recursive=False)
 
-            serial_number = tds[0].get_text()
+            serial_number = tds[0].text
 
-            date_str = tds[2].get_text()
+            date_str = tds[2].text
             try:
                 sale_date = datetime.strptime(date_str, "%Y-%m-%d").date()
             except ValueError:
                 # date may be null
                 logger.warning("parse presale date of serial number %s failed,"
                                " community_id=%s: %s",
-                               serial_number, self.id, date_str)
+                               serial_number, community_id, date_str)
                 sale_date = date.today()
 
             try:
-                status = tds[7].get_text()
+                status = tds[7].text
             except Exception as e:
                 # status may be null
                 logger.warning("get presale status of community %s failed: %s",
-                               self.id, e.__str__())
+                               community_id, e.__str__())
                 status = None
 
             presale_list.append(
                 {'serial_number': serial_number,
-                 'description': tds[1].get_text(),
+                 'description': tds[1].text,
                  'sale_date': sale_date,
-                 'total_number': int(tds[3].get_text()),
-                 'normal_number': int(tds[4].get_text()),
-                 'total_area': tds[5].get_text(),
-                 'normal_area': float(tds[6].get_text().split(' ')[0]),
+                 'total_number': int(tds[3].text),
+                 'normal_number': int(tds[4].text),
+                 'total_area': tds[5].text,
+                 'normal_area': float(tds[6].text.split(' ')[0]),
                  'status': status
                  })
 
@@ -283,7 +402,9 @@ class CommunityFD(Community):
 
         return presale_list
 
-    def _fd_parse_community(self, resp):
+    @classmethod
+    @parser_version(1)
+    def _fd_parse_community(cls, resp, outer_id):
         """The html page has the following skeleton:
         <html>
         ...
@@ -311,12 +432,12 @@ class CommunityFD(Community):
         ...
         </html>
         """
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        doc = parse_html(resp.text)
 
-        for table in soup.find_all('table'):
+        for table in doc.find_all('table'):
             # search recursively
             try:
-                if table.tr.td.get_text() == '项目名称：':
+                if table.find('tr').find('td').text == '项目名称：':
                     break
             except AttributeError:
                 continue
@@ -328,20 +449,20 @@ class CommunityFD(Community):
 
         # get area
         tds = trs[1].find_all('td', recursive=False)
-        area_name = tds[3].get_text()
+        area_name = tds[3].text
 
         # get company
         tds = trs[2].find_all('td', recursive=False)
-        company = tds[1].get_text()
+        company = tds[1].text
 
         # get community name for presale
-        src = urllib.parse.urlparse(soup.iframe['src'])
+        src = urllib.parse.urlparse(doc.find('iframe')['src'])
         params = urllib.parse.parse_qs(src.query)
-        project_id = self.fd_decode_project_id(params["projectID"][0])
-        if self.outer_id != project_id:
+        project_id = cls.fd_decode_project_id(params["projectID"][0])
+        if outer_id != project_id:
             raise ParseError("request fangdi.com.cn community page with "
                              "outer_id %s, but get outer_id %s: %s"
-                             % (self.outer_id, project_id, resp.url))
+                             % (outer_id, project_id, resp.url))
         presale_url_name = params["projectname"][0]
 
         return {"area_name": area_name,
@@ -355,6 +476,12 @@ class CommunityFD(Community):
 class PresalePermit(IdMixin, Base):
     __tablename__ = 'presale_permit'
 
+    __table_args__ = (
+        Index('ix_presale_permit_created_at', 'created_at'),
+        Index('ix_presale_permit_community_id', 'community_id'),
+        Base.__table_args__
+    )
+
     community_id = Column(INTEGER, ForeignKey('community.id'), nullable=False)
     community = relationship('CommunityFD', backref=backref('presales'),
                              foreign_keys=community_id)
@@ -377,40 +504,52 @@ class BatchJobFD(BatchJob):
         'polymorphic_identity': b"fangdi" + bytes(2),
     }
 
-    def _start(self, district_ids=None):
-
-        result = base.FINISHED
-
+    def _start(self, district_ids=None, prefetch_pages=None,
+               fd_presale_concurrency=None, fd_presale_policy=None,
+               fd_presale_max_age=None, fd_full_sweep_every=None):
+        return self.run_jobs(self.get_jobs(district_ids),
+                             prefetch_pages=prefetch_pages,
+                             fd_presale_concurrency=fd_presale_concurrency,
+                             fd_presale_policy=fd_presale_policy,
+                             fd_presale_max_age=fd_presale_max_age,
+                             fd_full_sweep_every=fd_full_sweep_every)
+
+    def get_jobs(self, district_ids=None):
+        """Return the unfinished jobs, creating the missing ones."""
+        jobs = []
         for district, job in self.get_district_and_job(district_ids):
             if job is not None and job.status == base.FINISHED:
                 continue
             elif job is None:
                 job = DistrictJob(district, self)
                 self.db_session.add(job)
-                self.commit()
-
-            try:
-                job.start(self.db_session, self.http_session,
-                          auto_commit=self.auto_commit)
-            except JobError as e:
-                logger.error("DistrictJob of id %s failed: %s", job.id, e)
-                job.status = base.FAILED
-                self.commit()
-                result = base.FAILED
+            jobs.append(job)
 
-        return result
+        self.commit()
+        return jobs
 
     def get_district_and_job(self, district_ids=None):
+        query = self.district_and_job_query(self.batch_number, district_ids)
+        return query.with_session(self.db_session).all()
+
+    @classmethod
+    def district_and_job_query(cls, batch_number, district_ids=None):
         if district_ids is not None:
             filter_ = DistrictFD.id.in_(district_ids)
         else:
             filter_ = None
 
-        return self._get_obj_and_job(DistrictFD, DistrictJob,
+        return cls.obj_and_job_query(batch_number, DistrictFD, DistrictJob,
                                      DistrictJob.district_id == DistrictFD.id,
                                      filter_=filter_,
                                      order=DistrictFD.outer_id)
 
+    @staticmethod
+    def created_query(cls_, begin, end):
+        """Return the query of the communities or presale permits created
+        between begin and end."""
+        return Query([cls_]).filter(cls_.created_at.between(begin, end))
+
     def mail_content(self):
 
         if self.status != base.FINISHED or self.db_session is None:
@@ -420,9 +559,9 @@ class BatchJobFD(BatchJob):
 
         content += "新出现的小区:\r\n"
         new_cs = {}
-        rs = (self.db_session.query(CommunityFD)
-              .filter(CommunityFD.created_at.between(self.created_at,
-                                                     self.last_modified_at))
+        rs = (self.created_query(CommunityFD, self.created_at,
+                                 self.last_modified_at)
+              .with_session(self.db_session)
               .all())
         for c in rs:
             new_cs[c.id] = c
@@ -431,15 +570,15 @@ class BatchJobFD(BatchJob):
             content += "    无 \r\n"
         else:
             for c in new_cs.values():
-                line = "    %s, %s \r\n" % (
-                       c.name, c._fd_community_request().prepare().url)
+                req = CommunityFD._fd_community_request(c.outer_id)
+                line = "    %s, %s \r\n" % (c.name, req.prepare().url)
                 content += line
 
         content += "新发预售证的小区:\r\n"
-        rs = (self.db_session.query(PresalePermit)
+        rs = (self.created_query(PresalePermit, self.created_at,
+                                 self.last_modified_at)
+              .with_session(self.db_session)
               .options(joinedload("community"))
-              .filter(PresalePermit.created_at.between(self.created_at,
-                                                       self.last_modified_at))
               .all())
 
         new_ps = []
@@ -453,8 +592,8 @@ class BatchJobFD(BatchJob):
         else:
             for p in new_ps:
                 c = p.community
-                line = "    %s, %s \r\n" % (
-                    c.name, c._fd_community_request().prepare().url)
+                req = CommunityFD._fd_community_request(c.outer_id)
+                line = "    %s, %s \r\n" % (c.name, req.prepare().url)
                 content += line
 
         if new_cs or new_ps:
@@ -477,47 +616,169 @@ class DistrictJob(Job):
         self.district = district
         self.district_id = district.id
 
-    def _start(self):
+    @property
+    def host(self):
+        return urllib.parse.urlparse(DistrictFD.SEARCH_URL).netloc
+
+    presale_policy = None
+    presale_max_age = None
+    full_sweep_every = None
+    # (community_id, serial_number) of the saved presale permits
+    known_presales = None
+
+    def _start(self, prefetch_pages=None, fd_presale_concurrency=None,
+               fd_presale_policy=None, fd_presale_max_age=None,
+               fd_full_sweep_every=None):
+
+        self.presale_policy = fd_presale_policy
+        self.presale_max_age = fd_presale_max_age
+        self.full_sweep_every = fd_full_sweep_every
+
+        concurrency = fd_presale_concurrency or 1
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                return self._track(prefetch_pages, executor)
+        else:
+            return self._track(prefetch_pages)
+
+    def _track(self, prefetch_pages=None, executor=None):
 
         result = base.FINISHED
 
         existing_outer_ids = {}
         skip_outer_ids = set()
-        query = (self.db_session.query(CommunityFD)
-                 .filter_by(district_id=self.district.id))
-        for c in query.all():
+        skipped = 0
+        query = self.communities_query(self.district.id)
+        for c in query.with_session(self.db_session).all():
             existing_outer_ids[c.outer_id] = c
             if not c.track_presale:
                 skip_outer_ids.add(c.outer_id)
+        self.known_presales = self.load_presales()
 
         # parse each page
-        for content in PagesIterator(self, self.district.fd_search):
-            c_list = content["community_list"]
-            for c_info in c_list:
-                outer_id = c_info.pop('outer_id')
-                if outer_id not in existing_outer_ids:
-                    c = CommunityFD(c_info.pop('name'), outer_id, self.district,
-                                    **c_info)
-                    self.db_session.add(c)
-                    self.db_session.flush()
-                    existing_outer_ids[outer_id] = c
-                elif outer_id not in skip_outer_ids:
+        search_func = self.district.fd_search_func()
+        with PagesIterator(self, search_func, prefetch_pages) as pages:
+            for content in pages:
+                c_list = content["community_list"]
+                self.insert_communities(c_list, existing_outer_ids)
+
+                communities = []
+                for c_info in c_list:
+                    outer_id = c_info.pop('outer_id')
+                    if outer_id in skip_outer_ids:
+                        continue
                     c = existing_outer_ids[outer_id]
-                else:
-                    c = None
 
-                if c is not None:
-                    try:
-                        c.check_presale_permit(self.db_session,
-                                               self.http_session)
-                    except (DownloadError, ParseError) as e:
-                        self.db_session.rollback()
-                        raise JobError("%s: %s" % (e.__class__.__name__, e))
+                    reason = c.presale_reason(self.batch_number, c_info,
+                                              self.presale_policy,
+                                              self.presale_max_age,
+                                              self.full_sweep_every)
+                    # the listing is compared by the next batch under the
+                    # incremental policy, and left as it was first seen
+                    # under the others.
+                    if (self.presale_policy == POLICY_INCREMENTAL
+                       and c.listing_changed(c_info)):
+                        c.total_number = c_info.get("total_number")
+                        c.total_area = c_info.get("total_area")
+
+                    if reason is None:
+                        skipped += 1
+                    else:
+                        communities.append(c)
+
+                try:
+                    self.check_presale_permits(communities, executor)
+                except (DownloadError, ParseError) as e:
+                    self.db_session.rollback()
+                    raise JobError("%s: %s" % (e.__class__.__name__, e))
 
-            self.commit()
+                self.commit()
 
+        if skipped:
+            logger.info("%s: presale check of %s communities skipped",
+                        self.district, skipped)
         return result
 
+    def load_presales(self):
+        """Return (community_id, serial_number) of all the presale permits
+        of the district, by one query."""
+        query = self.presales_query(self.district.id)
+        return set(tuple(row) for row in self.db_session.execute(query))
+
+    @staticmethod
+    def presales_query(district_id):
+        return (select([PresalePermit.community_id,
+                        PresalePermit.serial_number])
+                .select_from(PresalePermit.__table__.join(
+                    CommunityFD.__table__,
+                    PresalePermit.community_id == CommunityFD.id))
+                .where(CommunityFD.district_id == district_id))
+
+    @staticmethod
+    def communities_query(district_id, outer_ids=None):
+        """Return the query of the communities of the district, the ones
+        of outer_ids only if given. It is not bound to a session."""
+        query = Query([CommunityFD]).filter_by(district_id=district_id)
+        if outer_ids is not None:
+            query = query.filter(CommunityFD.outer_id.in_(outer_ids))
+        return query
+
+    def insert_communities(self, c_list, existing_outer_ids):
+        """Insert the communities of the page not in existing_outer_ids by
+        one statement, then load them by one query and add them into
+        existing_outer_ids."""
+        rows = {}
+        for c_info in c_list:
+            outer_id = c_info["outer_id"]
+            if outer_id in existing_outer_ids or outer_id in rows:
+                continue
+            rows[outer_id] = {
+                "name": c_info["name"],
+                "outer_id": outer_id,
+                "district_id": self.district.id,
+                "type": CommunityFD.__mapper__.polymorphic_identity,
+                "total_number": c_info.get("total_number"),
+                "total_area": c_info.get("total_area"),
+                "location": c_info.get("location"),
+                "company": c_info.get("company"),
+                "track_presale": True}
+        if not rows:
+            return
+
+        self.db_session.execute(CommunityFD.__table__.insert(),
+                                list(rows.values()))
+        query = self.communities_query(self.district.id, list(rows))
+        for c in query.with_session(self.db_session):
+            existing_outer_ids[c.outer_id] = c
+
+    def check_presale_permits(self, communities, executor=None):
+        """Check presale permits of the communities. Downloading and parsing
+        are done by the executor if given, while the results are always
+        written back in the current thread, which owns the db session.
+        """
+        if executor is None:
+            for c in communities:
+                c.check_presale_permit(self.db_session, self.http_session,
+                                       self.known_presales)
+                c.presale_batch_number = self.batch_number
+            return
+
+        # the functions are bound to the attributes loaded in this thread
+        futures = [executor.submit(c.fd_check_func(), self.http_session)
+                   for c in communities]
+        try:
+            results = [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+
+        # one by one in page order, so that a permit is added only once even
+        # if the community appears twice.
+        for c, (c_info, presales) in zip(communities, results):
+            c.update_presale_permit(self.db_session, c_info, presales,
+                                    self.known_presales)
+            c.presale_batch_number = self.batch_number
+
 
 __all__ = ['DistrictFD', 'CommunityFD', 'PresalePermit', 'BatchJobFD',
            'DistrictJob']
@@ -2,28 +2,46 @@
 
 import re
 import math
+import time
 import json
+import zlib
+import hashlib
 import logging
 import functools
+import urllib.parse
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from bs4 import BeautifulSoup
 from requests import Request
-from sqlalchemy import (Column, ForeignKey, ForeignKeyConstraint, func, select,
-                        case, text)
+from sqlalchemy import (Column, ForeignKey, ForeignKeyConstraint, Index, func,
+                        select, case, text, literal)
+from sqlalchemy.dialects import mysql
 from sqlalchemy.dialects.mysql import (BINARY, VARCHAR, INTEGER, BOOLEAN, FLOAT,
                                        DATE)
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import Query, relationship, backref
 
 from . import base
-from .base import (IdMixin, Base, Community, BatchJob, JobWithCommunity,
-                   PagesIterator)
-from ..exceptions import ParseError, JobError
+from .base import (IdMixin, Base, District, Area, Community, BatchJob,
+                   JobWithCommunity, PagesIterator)
+from ..exceptions import ParseError
 from .. import utils
+from ..utils.parser import (parse_pool, parse_html, parser_version, Region,
+                            count)
 
 
 logger = logging.getLogger(__name__)
 
+# policies to refresh the detail of houses
+POLICY_ALWAYS = "always"
+POLICY_INCREMENTAL = "incremental"
+
+# why the detail of a house record is fetched or not
+DETAIL_ALWAYS = "always"
+DETAIL_NEW = "new"
+DETAIL_PRICE = "price"
+DETAIL_STALE = "stale"
+DETAIL_SKIPPED = "skipped"
+
 
 class CommunityLJ(Community):
 
@@ -45,19 +63,44 @@ class CommunityLJ(Community):
     p_build_year = re.compile("(\d+)年|塔楼|板楼")
     p_area = re.compile("(\d+(\.\d+)?)平")
 
+    # the parts of the search page used by _lj_parse
+    lj_regions = (Region("h2", "total fl"),
+                  Region("div", "page-box house-lst-page-box"),
+                  Region("ul", "sellListContent"))
+
     def __init__(self, name, outer_id, area):
         Community.__init__(self, name, outer_id, area.district, area=area)
 
     def __str__(self):
         return "%s %s %s" % (self.id, self.outer_id, self.name)
 
+    @staticmethod
+    def shard_of(outer_id, shards):
+        """Return the shard of the community, the same in every process."""
+        return zlib.crc32(outer_id.encode("utf-8")) % shards
+
     def lj_search(self, http_session, page, number_per_page=None):
-        req = self._lj_search_request(page)
+        return self._lj_search(self.outer_id, http_session, page,
+                               number_per_page)
+
+    def lj_search_func(self, number_per_page=None):
+        """Return a search function that holds no reference to this object,
+        so it is safe to be called out of the thread owning the db session.
+        """
+        return functools.partial(self._lj_search, self.outer_id,
+                                 number_per_page=number_per_page)
+
+    @classmethod
+    def _lj_search(cls, outer_id, http_session, page, number_per_page=None):
+        req = cls._lj_search_request(outer_id, page)
         resp = utils.do_http_request(http_session, req)
-        return self._lj_parse(resp, page, number_per_page)
+        with utils.evict_on_error(http_session, resp):
+            return parse_pool.parse(cls._lj_parse, resp, page,
+                                    number_per_page)
 
-    def _lj_search_request(self, page):
-        url = self.SEARCH_URL % (page, self.outer_id)
+    @classmethod
+    def _lj_search_request(cls, outer_id, page):
+        url = cls.SEARCH_URL % (page, outer_id)
         return Request(url=url, method="GET")
 
     def update(self, average_price=None, house_available=None,
@@ -68,14 +111,15 @@ class CommunityLJ(Community):
         self.view_last_month = view_last_month
 
     @classmethod
+    @parser_version(1)
     def _lj_parse(cls, resp, page, number_per_page):
 
-        soup = BeautifulSoup(resp.text, "html.parser")
+        doc = parse_html(resp.text, cls.lj_regions)
 
         try:
             # get total page
-            total_num = int(soup.find("h2", class_="total fl").find("span")
-                            .get_text())
+            total_num = int(doc.find("h2", class_="total fl").find("span")
+                            .text)
             total_page = math.ceil(total_num / number_per_page)
         except (ValueError, AttributeError) as e:
             raise ParseError("parse total number of community page failed: %s,"
@@ -86,7 +130,7 @@ class CommunityLJ(Community):
             # no house_found
             on_page = 0
         else:
-            raw_div = soup.find("div", class_="page-box house-lst-page-box")
+            raw_div = doc.find("div", class_="page-box house-lst-page-box")
 
             if raw_div is None:
                 raise ParseError("can not find div of page information: %s"
@@ -109,7 +153,7 @@ class CommunityLJ(Community):
         # get house info
         houses_info = []
         if total_num > 0:
-            raw_ul = soup.find("ul", class_="sellListContent")
+            raw_ul = doc.find("ul", class_="sellListContent")
             if raw_ul is None:
                 raise ParseError("can not find house list: %s" % resp.url)
 
@@ -120,14 +164,14 @@ class CommunityLJ(Community):
                     h_outer_id = raw_li.find("div", class_="btn-follow"
                                              )["data-hid"]
                     h_price = int(float(raw_li.find("div", class_="totalPrice")
-                                        .span.get_text()))
+                                        .find("span").text))
                 except Exception as e:
                     logger.exception(e)
                     raise ParseError("parse house outer_id or price failed: %s"
                                      % resp.url)
 
                 position_info = raw_li.find("div", class_="positionInfo"
-                                            ).get_text()
+                                            ).text
                 rs = cls.p_build_year.search(position_info)
                 if rs is None:
                     logger.warning("get house position failed: %s, %s" %
@@ -141,7 +185,7 @@ class CommunityLJ(Community):
                         h_build_year = int(g_match)
                     h_floor = position_info[:rs.span()[0]]
 
-                house_info = raw_li.find("div", class_="houseInfo").get_text()
+                house_info = raw_li.find("div", class_="houseInfo").text
                 rs = cls.p_area.search(house_info)
                 if rs is None:
                     logger.warning("get house area failed: %s, %s" %
@@ -170,6 +214,12 @@ class CommunityLJ(Community):
 class HouseLJ(IdMixin, Base):
     __tablename__ = 'house'
 
+    __table_args__ = (
+        Index('ix_house_community_id_last_batch_number',
+              'community_id', 'last_batch_number'),
+        Base.__table_args__
+    )
+
     community_id = Column(INTEGER, ForeignKey('community.id'), nullable=False)
     outer_id = Column(VARCHAR(128), nullable=False)
 
@@ -189,11 +239,30 @@ class HouseLJ(IdMixin, Base):
     view_last_month = Column(INTEGER)
     view_last_week = Column(INTEGER)
 
+    # the last batch that fetched the detail page
+    detail_batch_number = Column(INTEGER)
+    # validators of the detail page
+    detail_etag = Column(VARCHAR(256))
+    detail_last_modified = Column(VARCHAR(64))
+    detail_hash = Column(VARCHAR(40))
+
     community = relationship('Community',
                              backref=backref('houses', order_by=view_last_month)
                              )
     SEARCH_URL = "http://sh.lianjia.com/ershoufang/%s.html"
 
+    # the parts of the detail page used by _lj_parse
+    lj_regions = (Region("div", "houseRecord"),
+                  Region("div", "transaction"),
+                  Region("div", "panel"))
+
+    # the common layout of the regions, for _lj_parse_fast
+    p_tag = re.compile("<[^>]*>")
+    p_transaction = re.compile(r'<span class="label">(挂牌时间|上次交易)</span>'
+                               r'\s*<span>([^<]*)</span>')
+    p_view_week = re.compile(r'<div class="count">\s*(\d+)\s*</div>')
+    p_view_month = re.compile(r'<span\b[^>]*>([^<]*)</span>')
+
     def __init__(self, outer_id, community, area=None, room=None,
                  build_year=None, floor=None, price=None,
                  last_batch_number=None):
@@ -204,27 +273,96 @@ class HouseLJ(IdMixin, Base):
                       last_batch_number=last_batch_number,
                       new=True, available=True, available_change_times=0)
 
-    def lj_search_request(self):
-        url = self.SEARCH_URL % self.outer_id
-        return Request(url=url, method="GET")
+    @staticmethod
+    def available_query(community_id, columns):
+        """Return the query of the columns of the available houses of the
+        community, ordered by area and price."""
+        return (select(columns)
+                .where(HouseLJ.community_id == community_id)
+                .where(HouseLJ.available.is_(True))
+                .order_by(HouseLJ.area, HouseLJ.price))
+
+    @staticmethod
+    def _detail_reason(detail_batch_number, batch_number, price_change,
+                       policy=None, max_age=None):
+        if policy is None or policy == POLICY_ALWAYS:
+            return DETAIL_ALWAYS
+        elif policy != POLICY_INCREMENTAL:
+            raise ValueError("unknown detail policy: %s" % policy)
+
+        if detail_batch_number is None:
+            return DETAIL_NEW
+        elif price_change:
+            return DETAIL_PRICE
+        elif max_age and batch_number - detail_batch_number >= max_age:
+            return DETAIL_STALE
+        else:
+            return None
 
-    def lj_parse(self, resp):
+    @classmethod
+    def _lj_search(cls, outer_id, http_session, detail_etag=None,
+                   detail_last_modified=None, detail_hash=None):
+        """Return the detail of the house, None if the page is not
+        modified, or only the validators of the page if it is returned
+        with the same content, which is not parsed."""
+        req = cls._lj_search_request(outer_id, detail_etag,
+                                     detail_last_modified)
+        resp = utils.do_http_request(http_session, req, ok_status=(200, 304))
+        if resp.status_code == 304:
+            return None
+
+        validators = {"detail_etag": resp.headers.get("ETag"),
+                      "detail_last_modified": resp.headers.get("Last-Modified")}
+        new_hash = hashlib.sha1(resp.content).hexdigest()
+        if new_hash == detail_hash:
+            return validators
+
+        with utils.evict_on_error(http_session, resp):
+            info = parse_pool.parse(cls._lj_parse, resp, outer_id)
+        info.update(validators)
+        info["detail_hash"] = new_hash
+        return info
 
-        soup = BeautifulSoup(resp.text, "html.parser")
+    @classmethod
+    def _lj_search_request(cls, outer_id, detail_etag=None,
+                           detail_last_modified=None):
+        url = cls.SEARCH_URL % outer_id
+        headers = {}
+        if detail_etag:
+            headers["If-None-Match"] = detail_etag
+        if detail_last_modified:
+            headers["If-Modified-Since"] = detail_last_modified
+        return Request(url=url, method="GET", headers=headers)
+
+    @classmethod
+    @parser_version(1)
+    def _lj_parse(cls, resp, outer_id):
+
+        info = cls._lj_parse_fast(resp.text, outer_id)
+        if info is not None:
+            count("lj_detail_fast")
+            return info
+        count("lj_detail_fallbacks")
+        return cls._lj_parse_tree(resp, outer_id)
+
+    @classmethod
+    def _lj_parse_tree(cls, resp, outer_id):
+        """Parse the detail page by the tree of the parser backend."""
+        doc = parse_html(resp.text, cls.lj_regions)
         info = {}
 
         # check
-        house_record = soup.find("div", "houseRecord").text
-        if house_record.find(self.outer_id) < 0:
+        house_record = doc.find("div", class_="houseRecord").text
+        if house_record.find(outer_id) < 0:
             raise ParseError("get house page with invalid outer_id, %s: %s"
                              % (house_record, resp.url))
 
         # transaction info
-        raw_div = soup.find("div", class_="transaction")
+        raw_div = doc.find("div", class_="transaction")
         if raw_div is None:
             logger.warning("get transaction div failed: %s" % resp.url)
         else:
-            ts_info = self.lj_parse_transaction_info(raw_div)
+            ts_info = cls.lj_parse_transaction_info(raw_div)
             if not ts_info:
                 # None or {}
                 logger.warning("parse transaction info failed: %s" % resp.url)
@@ -235,12 +373,50 @@ class HouseLJ(IdMixin, Base):
                 info.update(ts_info)
 
         # view info
-        raw_div = soup.find("div", class_="panel")
+        raw_div = doc.find("div", class_="panel")
         info["view_last_week"] = int(raw_div.find("div", class_="count").text)
         info["view_last_month"] = int(raw_div.find("span").text)
 
         return info
 
+    @classmethod
+    def _lj_parse_fast(cls, text, outer_id):
+        """Parse the detail page of the common layout by regular expressions,
+        which is much faster than building a tree. Return None if the page
+        is not of the common layout, so that it is parsed by the tree."""
+        spans = [region.find(text) for region in cls.lj_regions]
+        if None in spans:
+            return None
+        house_record, transaction, panel = [text[start:end]
+                                            for start, end in spans]
+
+        if cls.p_tag.sub("", house_record).find(outer_id) < 0:
+            return None
+
+        info = {}
+        for label, value in cls.p_transaction.findall(transaction):
+            key = ("date_to_market" if label == "挂牌时间"
+                   else "last_purchase_date")
+            try:
+                info[key] = datetime.strptime(value, "%Y-%m-%d").date()
+            except ValueError:
+                pass
+            if len(info) == 2:
+                break
+        if "date_to_market" not in info:
+            return None
+
+        rs_week = cls.p_view_week.search(panel)
+        # the first span of the panel, like the tree
+        rs_month = cls.p_view_month.match(panel, max(panel.find("<span"), 0))
+        try:
+            info["view_last_week"] = int(rs_week.group(1))
+            info["view_last_month"] = int(rs_month.group(1))
+        except (AttributeError, ValueError):
+            return None
+
+        return info
+
     @staticmethod
     def lj_parse_transaction_info(raw_div):
 
@@ -253,11 +429,11 @@ class HouseLJ(IdMixin, Base):
         for raw_span in raw_spans:
             try:
                 if raw_span.text == "挂牌时间":
-                    tmp = datetime.strptime(raw_span.findNext().text,
+                    tmp = datetime.strptime(raw_span.find_next().text,
                                             "%Y-%m-%d")
                     info["date_to_market"] = tmp.date()
                 elif raw_span.text == "上次交易":
-                    tmp = datetime.strptime(raw_span.findNext().text,
+                    tmp = datetime.strptime(raw_span.find_next().text,
                                             "%Y-%m-%d")
                     info["last_purchase_date"] = tmp.date()
             except ValueError:
@@ -277,6 +453,8 @@ class CommunityRecordLJ(IdMixin, Base):
     __tablename__ = 'community_record'
 
     __table_args__ = (
+        Index('ix_community_record_batch_number_community_id',
+              'batch_number', 'community_id'),
         ForeignKeyConstraint(('batch_number', 'batch_type'),
                              ('batch_job.batch_number', 'batch_job.type')),
         Base.__table_args__
@@ -315,6 +493,10 @@ class HouseRecordLJ(IdMixin, Base):
     __tablename__ = 'house_record'
 
     __table_args__ = (
+        Index('ix_house_record_batch_number_community_id',
+              'batch_number', 'community_id'),
+        Index('ix_house_record_community_id_batch_number',
+              'community_id', 'batch_number'),
         ForeignKeyConstraint(('batch_number', 'batch_type'),
                              ('batch_job.batch_number', 'batch_job.type')),
         Base.__table_args__
@@ -329,6 +511,8 @@ class HouseRecordLJ(IdMixin, Base):
     price_change = Column(INTEGER)
     view_last_month = Column(INTEGER)
     view_last_week = Column(INTEGER)
+    # see DETAIL_*
+    detail_source = Column(VARCHAR(16))
 
     community = relationship('Community', foreign_keys=community_id,
                              backref=backref('house_records',
@@ -344,15 +528,32 @@ class HouseRecordLJ(IdMixin, Base):
                       batch_job=batch_job, **kwargs)
         house.last_batch_number = batch_job.batch_number
 
-    def load_detail(self, http_session):
-        resp = utils.do_http_request(http_session,
-                                     self.house.lj_search_request())
-        info = self.house.lj_parse(resp)
-        self.house.view_last_week = self.view_last_week = info["view_last_week"]
-        self.house.view_last_month = self.view_last_month = info["view_last_month"]
-        for key in ("date_to_market", "last_purchase_date"):
-            if key in info:
-                setattr(self.house, key, info[key])
+    @staticmethod
+    def avg_price_query(begin, end):
+        """Return the query of the prices and areas of the houses recorded
+        by the batches created between begin and end, which can be
+        filtered by the community, area or district."""
+        joined_table = (
+            HouseRecordLJ.__table__
+            .join(HouseLJ.__table__,
+                  HouseRecordLJ.house_id == HouseLJ.id)
+            .join(Community.__table__,
+                  HouseRecordLJ.community_id == Community.id)
+            .join(District.__table__,
+                  Community.district_id == District.id)
+            .join(Area.__table__,
+                  Community.area_id == Area.id)
+            .join(BatchJob.__table__,
+                  (HouseRecordLJ.batch_type == BatchJob.type) & (
+                   HouseRecordLJ.batch_number == BatchJob.batch_number))
+        )
+        return (select([HouseRecordLJ.community_id,
+                        func.date(BatchJobLJ.created_at).label("created_at"),
+                        (500/HouseLJ.area).label("area"),
+                        (HouseRecordLJ.price/HouseLJ.area).label("price")])
+                .select_from(joined_table)
+                .where((HouseRecordLJ.price+HouseLJ.area).isnot(None))
+                .where(BatchJobLJ.created_at.between(begin, end)))
 
 
 class BatchJobLJ(BatchJob):
@@ -360,27 +561,27 @@ class BatchJobLJ(BatchJob):
         'polymorphic_identity': b'lianjia' + bytes(1),
     }
 
-    def _start(self, lj_number_per_page=None, community_outer_ids=None):
-        result = base.FINISHED
-
-        for community, job in self.get_community_and_job(community_outer_ids):
-            if job is not None and job.status == base.FINISHED:
-                continue
-            elif job is None:
-                job = CommunityJob(community, self)
-                self.db_session.add(job)
-                self.commit()
-
-            logger.info("lianjia community start: %s" % community)
-            try:
-                job.start(self.db_session, self.http_session,
-                          auto_commit=self.auto_commit,
-                          lj_number_per_page=lj_number_per_page)
-            except JobError as e:
-                logger.error("CommunityJob of id %s failed: %s", job.id, e)
-                job.status = base.FAILED
-                self.commit()
-                result = base.FAILED
+    def _start(self, lj_number_per_page=None, community_outer_ids=None,
+               lj_detail_concurrency=None, lj_detail_policy=None,
+               lj_detail_max_age=None, prefetch_pages=None, shard=None):
+        """shard is a tuple (i, n). If given, only the communities of the
+        i-th of n shards are tracked, and the batch job is left running until
+        the other shards are done, by other processes with the same batch
+        job."""
+
+        jobs = self.get_jobs(community_outer_ids, shard)
+        result = self.run_jobs(jobs, lj_number_per_page=lj_number_per_page,
+                               lj_detail_concurrency=lj_detail_concurrency,
+                               lj_detail_policy=lj_detail_policy,
+                               lj_detail_max_age=lj_detail_max_age,
+                               prefetch_pages=prefetch_pages)
+
+        if result == base.FINISHED and shard is not None:
+            unfinished = self.count_unfinished_communities(community_outer_ids)
+            if unfinished > 0:
+                logger.info("shard %s/%s finished, %s communities left to"
+                            " other shards", shard[0], shard[1], unfinished)
+                return base.RUNNING
 
         # is not able to put all the validation in the unit test,
         # so check the result when finished.
@@ -389,63 +590,121 @@ class BatchJobLJ(BatchJob):
 
         return result
 
+    def get_jobs(self, community_outer_ids=None, shard=None):
+        """Return the unfinished jobs, creating the missing ones."""
+        jobs = []
+        for community, job in self.get_community_and_job(community_outer_ids):
+            if (shard is not None
+               and community.shard_of(community.outer_id, shard[1]) != shard[0]):
+                continue
+            elif job is not None and job.status == base.FINISHED:
+                continue
+            elif job is None:
+                job = CommunityJob(community, self)
+                self.db_session.add(job)
+            jobs.append(job)
+
+        self.commit()
+        return jobs
+
     def get_community_and_job(self, community_outer_ids):
+        query = self.community_and_job_query(self.batch_number,
+                                             community_outer_ids)
+        return query.with_session(self.db_session).all()
+
+    @classmethod
+    def community_and_job_query(cls, batch_number, community_outer_ids=None):
         if community_outer_ids is None:
             filter_ = None
         else:
             filter_ = CommunityLJ.outer_id.in_(community_outer_ids)
 
-        return self._get_obj_and_job(CommunityLJ, CommunityJob,
+        return cls.obj_and_job_query(batch_number, CommunityLJ, CommunityJob,
                                      CommunityJob.community_id == CommunityLJ.id,
                                      filter_=filter_,
                                      order=CommunityLJ.outer_id)
 
+    def count_unfinished_communities(self, community_outer_ids=None):
+        return sum(1 for _, job in
+                   self.get_community_and_job(community_outer_ids)
+                   if job is None or job.status != base.FINISHED)
+
     def check_result(self):
+        """Check the counters added by the community jobs against the
+        records of this batch. If deep_check is set, the houses of all the
+        batches are scanned instead, which takes time growing with the
+        history rather than with the batch."""
         # each community should has a record for this batch
-        join_cond = (CommunityLJ.id == CommunityRecordLJ.community_id) & (
-                     CommunityRecordLJ.batch_number == self.batch_number)
-        null_num = (self.db_session.query(func.count(CommunityLJ.id))
-                    .select_from(CommunityLJ)
-                    .outerjoin(CommunityRecordLJ, join_cond)
-                    .filter(CommunityRecordLJ.batch_number.is_(None))
-                    .scalar())
+        null_num = (self.untracked_communities_query(self.batch_number)
+                    .with_session(self.db_session).scalar())
         if null_num > 0:
             logger.error("failed to track some lianjia communities")
             return base.FAILED
 
+        if self.deep_check:
+            return self.deep_check_result()
+
+        # number of house_record written should equal the number of house
+        # that available
+        counters = self.get_counters()
+        if counters["record_number"] != counters["available_number"]:
+            logger.error("number of house_record and number of house that"
+                         " available mismatch: %s", counters)
+            return base.FAILED
+
+        # number of new house and missing house should match
+        rs_cr = self.sum_community_records()
+        if ((rs_cr.new_number or 0) != counters["new_number"]
+           or (rs_cr.missing_number or 0) != counters["missing_number"]):
+            logger.error("new_number or missing number mismatch: %s",
+                         counters)
+            return base.FAILED
+
+        return base.FINISHED
+
+    def deep_check_result(self):
         # number of house_record should equal the number of house that available
-        num_record = (self.db_session.query(func.count(HouseRecordLJ.id))
-                      .filter_by(batch_number=self.batch_number)
-                      .scalar())
-        num_house = (self.db_session.query(func.count(HouseLJ.id))
-                     .filter(HouseLJ.available.is_(True))
-                     .scalar())
-        if num_record != num_house:
+        num_record = self.db_session.execute(
+            CommunityJob.record_number_query(self.batch_number)).scalar()
+        query = CommunityJob.house_numbers_query(self.batch_number)
+        rs_house = self.db_session.execute(query).first()
+        if num_record != (rs_house.available or 0):
             logger.error("number of house_record and number of house that"
                          " available mismatch.")
             return base.FAILED
 
         # number of new house and missing house should match
-        rs_cr = (self.db_session.query(func.sum(CommunityRecordLJ.new_number
-                                                ).label("new_number"),
-                                       func.sum(CommunityRecordLJ.missing_number
-                                                ).label("missing_number"))
-                 .filter_by(batch_number=self.batch_number)
-                 .one())
-        nc = func.sum(case([(HouseLJ.new.is_(True), 1)], else_=0)
-                              ).label("new_number")
-        mc = func.sum(
-                case([(HouseLJ.last_batch_number == self.batch_number-1, 1)],
-                     else_=0)).label("missing_number")
-        rs_house = (self.db_session.query(nc, mc).one())
-
-        if (rs_cr.new_number != rs_house.new_number
-           or rs_cr.missing_number != rs_house.missing_number):
+        rs_cr = self.sum_community_records()
+        if (rs_cr.new_number != rs_house.new
+           or rs_cr.missing_number != rs_house.missing):
             logger.error("new_number or missing number mismatch.")
             return base.FAILED
 
         return base.FINISHED
 
+    def sum_community_records(self):
+        return (self.sum_community_records_query(self.batch_number)
+                .with_session(self.db_session).one())
+
+    @staticmethod
+    def untracked_communities_query(batch_number):
+        """Return the query counting the communities without a record of
+        the batch."""
+        join_cond = (CommunityLJ.id == CommunityRecordLJ.community_id) & (
+                     CommunityRecordLJ.batch_number == batch_number)
+        return (Query([func.count(CommunityLJ.id)])
+                .select_from(CommunityLJ)
+                .outerjoin(CommunityRecordLJ, join_cond)
+                .filter(CommunityRecordLJ.batch_number.is_(None)))
+
+    @staticmethod
+    def sum_community_records_query(batch_number):
+        return (Query([func.sum(CommunityRecordLJ.new_number
+                                ).label("new_number"),
+                       func.sum(CommunityRecordLJ.missing_number
+                                ).label("missing_number")])
+                .filter_by(batch_number=batch_number))
+
 
 class CommunityJob(JobWithCommunity):
     __mapper_args__ = {
@@ -456,81 +715,369 @@ class CommunityJob(JobWithCommunity):
                              foreign_keys=JobWithCommunity.community_id,
                              primaryjoin=JobWithCommunity.community_id==CommunityLJ.id)
 
-    def _start(self, lj_number_per_page=None):
-
-        existing_outer_ids = {h.outer_id: h for h in self.community.houses}
-        search_func = functools.partial(self.community.lj_search,
-                                        number_per_page=lj_number_per_page)
-
-        for content in PagesIterator(self, search_func):
-            c_info = content["community_info"]
-            houses_info = content["houses_info"]
-
-            if c_info is not None:
-                # only page 1 will return community_info
-                c_record = CommunityRecordLJ(self.community, self.batch_job,
-                                             **c_info)
-                self.community.update(**c_info)
-                self.db_session.add(c_record)
-
-            for h_info in houses_info:
-                if h_info["outer_id"] in existing_outer_ids:
-                    house = existing_outer_ids[h_info["outer_id"]]
-                    price_change = h_info["price"] - house.price
-                    # update house info
-                    house.price = h_info["price"]
-                    house.new = False
-                    if not house.available:
-                        house.available = True
-                        house.available_change_times += 1
-                else:
-                    house = HouseLJ(h_info.pop("outer_id"), self.community,
-                                    **h_info)
-                    price_change = None
-
-                # new house or house not check
-                # the house may be checked more than once
-                if (house.last_batch_number is None
-                   or house.last_batch_number != self.batch_number):
-                    h_record = HouseRecordLJ(house, self.batch_job,
-                                             price=h_info["price"],
-                                             price_change=price_change)
-                    self.db_session.add(h_record)
-                    h_record.load_detail(self.http_session)
-
-            self.commit()
+    @property
+    def host(self):
+        return urllib.parse.urlparse(CommunityLJ.SEARCH_URL).netloc
+
+    detail_policy = None
+    detail_max_age = None
+
+    # house records of this batch and new houses written by the job,
+    # added to the counters of the batch job when it finishes
+    record_number = 0
+    new_number = 0
+
+    # columns of a house changed by tracking
+    tracked_columns = ("price", "new", "available", "available_change_times",
+                       "last_batch_number", "view_last_week",
+                       "view_last_month", "date_to_market",
+                       "last_purchase_date", "detail_batch_number",
+                       "detail_etag", "detail_last_modified", "detail_hash")
+
+    def _start(self, lj_number_per_page=None, lj_detail_concurrency=None,
+               lj_detail_policy=None, lj_detail_max_age=None,
+               prefetch_pages=None):
+
+        self.detail_policy = lj_detail_policy
+        self.detail_max_age = lj_detail_max_age
+
+        concurrency = lj_detail_concurrency or 1
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                return self._track(lj_number_per_page, prefetch_pages,
+                                   executor)
+        else:
+            return self._track(lj_number_per_page, prefetch_pages)
+
+    def _track(self, lj_number_per_page, prefetch_pages=None, executor=None):
+
+        existing_houses = self.load_houses()
+        # a retried job resumes at next_page, the houses of the pages
+        # tracked by the former run are counted from their rows
+        recorded = [house for house in existing_houses.values()
+                    if house["last_batch_number"] == self.batch_number]
+        self.record_number = len(recorded)
+        self.new_number = sum(1 for house in recorded if house["new"])
+        tracked_outer_ids = set()
+        search_func = self.community.lj_search_func(lj_number_per_page)
+
+        db_seconds = 0
+        page_number = 0
+        with PagesIterator(self, search_func, prefetch_pages) as pages:
+            for content in pages:
+                seconds = self._track_page(content, existing_houses,
+                                           tracked_outer_ids, executor)
+                page_number += 1
+                db_seconds += seconds
+                logger.debug("%s: db time of page %s: %.3fs",
+                             self.community, page_number, seconds)
+        logger.info("%s: db time of %s pages: %.3fs, %s houses",
+                    self.community, page_number, db_seconds,
+                    len(tracked_outer_ids))
 
         # update the state of missing houses
         data = {HouseLJ.new: False,
                 HouseLJ.available: False,
                 HouseLJ.available_change_times:
                     HouseLJ.available_change_times + 1}
-        (self.db_session.query(HouseLJ)
-         .filter_by(community_id=self.community.id)
-         .filter(HouseLJ.last_batch_number < self.batch_number)
+        (self.missing_houses_query(self.community.id, self.batch_number)
+         .with_session(self.db_session)
          .update(data))
 
         # new number and miss number
+        query = self.house_numbers_query(self.batch_number,
+                                         self.community_id)
+        rs = self.db_session.execute(query).fetchall()[0]
+
+        data = {CommunityRecordLJ.new_number: rs.new,
+                CommunityRecordLJ.missing_number: rs.missing}
+        (self.community_record_query(self.community.id, self.batch_number)
+         .with_session(self.db_session)
+         .update(data))
+
+        # the missing houses are counted from the rows of load_houses, the
+        # others by the inserts, so that they are checked against the
+        # numbers from the db by check_result
+        missing_number = sum(
+            1 for house in existing_houses.values()
+            if house["last_batch_number"] == self.batch_number - 1)
+        BatchJob.add_counters(self.db_session, self.batch_number,
+                              self.batch_type,
+                              record_number=self.record_number,
+                              available_number=rs.available or 0,
+                              new_number=self.new_number,
+                              missing_number=missing_number)
+
+        return base.FINISHED
+
+    @staticmethod
+    def missing_houses_query(community_id, batch_number):
+        """Return the query of the houses of the community not seen in the
+        batch. It is not bound to a session."""
+        return (Query([HouseLJ])
+                .filter_by(community_id=community_id)
+                .filter(HouseLJ.last_batch_number < batch_number))
+
+    @staticmethod
+    def house_numbers_query(batch_number, community_id=None):
+        """Return the query of the numbers of new, missing and available
+        houses, of the community if given, or of all the communities."""
         # warning: pymysql will convert result of sum(boolean) to boolean
         col_new = func.sum(func.convert(HouseLJ.new, text("INTEGER"))
                            ).label("new")
         col_missing = func.sum(
-                        case([(HouseLJ.last_batch_number == self.batch_number-1, 1)],
+                        case([(HouseLJ.last_batch_number == batch_number-1, 1)],
                              else_=0)
                       ).label("missing")
+        col_available = func.sum(func.convert(HouseLJ.available,
+                                              text("INTEGER"))
+                                 ).label("available")
 
-        query = (select([col_new, col_missing])
-                 .where(HouseLJ.community_id == self.community_id))
-        rs = self.db_session.execute(query).fetchall()[0]
+        query = select([col_new, col_missing, col_available])
+        if community_id is not None:
+            query = query.where(HouseLJ.community_id == community_id)
+        return query
 
-        data = {CommunityRecordLJ.new_number: rs.new,
-                CommunityRecordLJ.missing_number: rs.missing}
-        (self.db_session.query(CommunityRecordLJ)
-         .filter_by(batch_number=self.batch_number,
-                    community_id=self.community.id)
-         .update(data))
+    @staticmethod
+    def record_number_query(batch_number, community_id=None):
+        """Return the query of the number of house records of the batch,
+        of the community if given, or of all the communities."""
+        query = (select([func.count(HouseRecordLJ.id)])
+                 .where(HouseRecordLJ.batch_number == batch_number))
+        if community_id is not None:
+            query = query.where(HouseRecordLJ.community_id == community_id)
+        return query
 
-        return base.FINISHED
+    @staticmethod
+    def community_record_query(community_id, batch_number):
+        return (Query([CommunityRecordLJ])
+                .filter_by(batch_number=batch_number,
+                           community_id=community_id))
+
+    def _track_page(self, content, existing_houses, tracked_outer_ids,
+                    executor=None):
+        """Track the houses of a page and return the seconds spent on
+        writing them into the db.
+
+        The houses are written by a constant number of statements whatever
+        the size of the page: existing houses are updated by update_houses,
+        new houses are inserted by insert_houses, and the records of the
+        existing houses by insert_records. Existing houses are the rows
+        returned by load_houses rather than ORM objects, which would be
+        refreshed one by one after each commit.
+        """
+        c_info = content["community_info"]
+        houses_info = content["houses_info"]
+
+        start_time = time.monotonic()
+        if c_info is not None:
+            # only page 1 will return community_info
+            c_record = CommunityRecordLJ(self.community, self.batch_job,
+                                         **c_info)
+            self.community.update(**c_info)
+            self.db_session.add(c_record)
+
+        # (house, h_info, price change, reason, record or not)
+        existing = []
+        new_houses = []
+        new_reasons = []
+        for h_info in houses_info:
+            if h_info["outer_id"] in tracked_outer_ids:
+                # the house may be checked more than once
+                continue
+            tracked_outer_ids.add(h_info["outer_id"])
+
+            house = existing_houses.get(h_info["outer_id"])
+            if house is None:
+                new_houses.append(h_info)
+                new_reasons.append(HouseLJ._detail_reason(
+                    None, self.batch_number, None, self.detail_policy,
+                    self.detail_max_age))
+                continue
+
+            price_change = h_info["price"] - house["price"]
+            # recorded by the former run of this job
+            recorded = house["last_batch_number"] == self.batch_number
+            if recorded:
+                reason = None
+            else:
+                reason = HouseLJ._detail_reason(house["detail_batch_number"],
+                                                self.batch_number,
+                                                price_change,
+                                                self.detail_policy,
+                                                self.detail_max_age)
+            existing.append((house, h_info, price_change, reason,
+                             not recorded))
+        seconds = time.monotonic() - start_time
+
+        funcs = [functools.partial(HouseLJ._lj_search, house["outer_id"],
+                                   detail_etag=house["detail_etag"],
+                                   detail_last_modified=house[
+                                       "detail_last_modified"],
+                                   detail_hash=house["detail_hash"])
+                 for house, _, _, reason, _ in existing
+                 if reason is not None]
+        funcs += [functools.partial(HouseLJ._lj_search, h_info["outer_id"])
+                  for h_info, reason in zip(new_houses, new_reasons)
+                  if reason is not None]
+        details = iter(self.search_details(funcs, executor))
+
+        start_time = time.monotonic()
+        house_rows = []
+        record_rows = []
+        for house, h_info, price_change, reason, record in existing:
+            detail = None if reason is None else next(details)
+            row = self.house_values(house, h_info, reason, detail)
+            house_rows.append(row)
+            if record:
+                record_rows.append(self.record_values(
+                    row, price_change, reason or DETAIL_SKIPPED))
+        new_details = [None if reason is None else next(details)
+                       for reason in new_reasons]
+
+        self.update_houses(house_rows)
+        for row in house_rows:
+            existing_houses[row["outer_id"]] = row
+        self.insert_records(record_rows)
+        self.insert_houses(new_houses, new_reasons, new_details)
+        self.commit()
+        return seconds + time.monotonic() - start_time
+
+    def load_houses(self):
+        """Return the houses of the community as dicts of the id, the
+        outer_id and the tracked columns, by outer_id."""
+        query = self.houses_query(self.community.id)
+        return {row["outer_id"]: dict(row.items())
+                for row in self.db_session.execute(query)}
+
+    @classmethod
+    def houses_query(cls, community_id):
+        keys = ("id", "community_id", "outer_id") + cls.tracked_columns
+        return (select([HouseLJ.__table__.c[k] for k in keys])
+                .where(HouseLJ.community_id == community_id))
+
+    def house_values(self, house, h_info, reason, detail):
+        """Return the row of the house after tracking. house is the one
+        from load_houses, or None if it is a new one. reason and detail are
+        the ones of the detail page, both None if it is skipped, and detail
+        is None if the page is not modified, or has only the validators if
+        its content is the same."""
+        if house is None:
+            row = dict.fromkeys(self.tracked_columns)
+            row.update({"community_id": self.community.id,
+                        "outer_id": h_info["outer_id"],
+                        "area": h_info.get("area"),
+                        "room": h_info.get("room"),
+                        "build_year": h_info.get("build_year"),
+                        "floor": h_info.get("floor"),
+                        "price_origin": h_info["price"],
+                        "new": True,
+                        "available": True,
+                        "available_change_times": 0})
+        elif house["last_batch_number"] == self.batch_number:
+            # recorded by the former run of this job, new is kept
+            row = dict(house)
+        else:
+            row = dict(house, new=False)
+            if not house["available"]:
+                row["available"] = True
+                row["available_change_times"] += 1
+
+        row["price"] = h_info["price"]
+        row["last_batch_number"] = self.batch_number
+        if reason is not None:
+            row["detail_batch_number"] = self.batch_number
+        if detail is not None:
+            for key in ("view_last_week", "view_last_month",
+                        "date_to_market", "last_purchase_date",
+                        "detail_etag", "detail_last_modified", "detail_hash"):
+                if key in detail:
+                    row[key] = detail[key]
+        return row
+
+    def record_values(self, row, price_change, detail_source):
+        """Return the house record of this batch for the row of a house."""
+        return {"community_id": self.community.id,
+                "house_id": row["id"],
+                "batch_number": self.batch_number,
+                "batch_type": self.batch_type,
+                "price": row["price"],
+                "price_change": price_change,
+                "view_last_month": row["view_last_month"],
+                "view_last_week": row["view_last_week"],
+                "detail_source": detail_source}
+
+    def update_houses(self, rows):
+        """Write the tracked columns of existing houses by one statement,
+        INSERT ... ON DUPLICATE KEY UPDATE for mysql, or UPDATE with CASE
+        for the others."""
+        if not rows:
+            return
+
+        table = HouseLJ.__table__
+        now = datetime.now()
+        if self.db_session.get_bind(HouseLJ).dialect.name == "mysql":
+            keys = ("id", "community_id", "outer_id") + self.tracked_columns
+            stmt = mysql.insert(table).values(
+                       [{k: row[k] for k in keys} for row in rows])
+            values = {c: stmt.inserted[c] for c in self.tracked_columns}
+            values["last_modified_at"] = now
+            stmt = stmt.on_duplicate_key_update(**values)
+        else:
+            values = {c: case({row["id"]: literal(row[c], table.c[c].type)
+                               for row in rows}, value=table.c.id)
+                      for c in self.tracked_columns}
+            values["last_modified_at"] = now
+            stmt = (table.update()
+                    .where(table.c.id.in_([row["id"] for row in rows]))
+                    .values(values))
+        self.db_session.execute(stmt)
+
+    def insert_houses(self, houses_info, reasons, details):
+        """Insert new houses and their records of this batch, by one
+        executemany for each table. The ids of the houses are fetched in one
+        query. reasons and details are the ones of the detail pages of the
+        houses, both None if it is skipped.
+        """
+        if not houses_info:
+            return
+
+        house_rows = [self.house_values(None, h_info, reason, detail)
+                      for h_info, reason, detail
+                      in zip(houses_info, reasons, details)]
+        self.db_session.execute(HouseLJ.__table__.insert(), house_rows)
+        self.new_number += len(house_rows)
+
+        outer_ids = [row["outer_id"] for row in house_rows]
+        query = self.house_ids_query(self.community.id, outer_ids)
+        house_ids = dict(self.db_session.execute(query).fetchall())
+
+        for row in house_rows:
+            row["id"] = house_ids[row["outer_id"]]
+        self.insert_records([self.record_values(row, None,
+                                                reason or DETAIL_SKIPPED)
+                             for row, reason in zip(house_rows, reasons)])
+
+    @staticmethod
+    def house_ids_query(community_id, outer_ids):
+        return (select([HouseLJ.outer_id, HouseLJ.id])
+                .where((HouseLJ.community_id == community_id)
+                       & HouseLJ.outer_id.in_(outer_ids)))
+
+    def insert_records(self, rows):
+        if rows:
+            self.db_session.execute(HouseRecordLJ.__table__.insert(), rows)
+            self.record_number += len(rows)
+
+    def search_details(self, funcs, executor=None):
+        """Call the functions with the http session, by the executor if
+        given, and return the results in order. The functions must not touch
+        the db session."""
+        if executor is None:
+            return [f(self.http_session) for f in funcs]
+
+        futures = [executor.submit(f, self.http_session) for f in funcs]
+        return [future.result() for future in futures]
 
 
 __all__ = ['CommunityLJ', 'HouseLJ', 'CommunityRecordLJ', 'HouseRecordLJ',
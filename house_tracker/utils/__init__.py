@@ -1,10 +1,18 @@
 
 import time
+import random
 import logging
+import threading
+import contextlib
+import email.utils
+import urllib.parse
+from datetime import datetime, timezone
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from ..exceptions import DownloadError
+from ..exceptions import DownloadError, ParseError
+from .cache import normalize_url, ResponseCache
 
 logger = logging.getLogger(__name__)
 
@@ -26,30 +34,286 @@ class SingletonMeta(type):
         return cls.instance
 
 
-def do_http_request(session, request, timeout=5):
+class HttpSession(requests.Session):
+    """requests.Session with a tuned connection pool and default timeouts.
 
+    Connections are kept alive and reused unless keep_alive is False. The
+    pool blocks when all the connections to a host are in use, instead of
+    opening one more that would be discarded after the request.
+    """
+
+    # a ResponseCache recording every response of status 200
+    recorder = None
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, keep_alive=True,
+                 connect_timeout=3.05, read_timeout=5):
+        requests.Session.__init__(self)
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize, pool_block=True)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        if not keep_alive:
+            self.headers["Connection"] = "close"
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    @classmethod
+    def from_config(cls, config):
+        session = cls(pool_connections=config.http_pool_connections,
+                      pool_maxsize=config.http_pool_maxsize,
+                      keep_alive=config.http_keep_alive,
+                      connect_timeout=config.http_connect_timeout,
+                      read_timeout=config.http_read_timeout)
+        if config.record_dir:
+            session.recorder = ResponseCache(config.record_dir)
+        return session
+
+    def send(self, request, **kwargs):
+        # a single number given by the caller is the read timeout
+        timeout = kwargs.get("timeout")
+        if timeout is None:
+            kwargs["timeout"] = (self.connect_timeout, self.read_timeout)
+        elif not isinstance(timeout, tuple):
+            kwargs["timeout"] = (self.connect_timeout, timeout)
+        return requests.Session.send(self, request, **kwargs)
+
+    def pool_stats(self):
+        """Return the number of requests, new connections and reused
+        connections of each host pool."""
+        stats = {}
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                if pool is None:
+                    continue
+                host = "%s:%s" % (pool.host, pool.port)
+                stats[host] = {"requests": pool.num_requests,
+                               "connections": pool.num_connections,
+                               "reused": (pool.num_requests
+                                          - pool.num_connections)}
+        return stats
+
+
+class TokenBucket:
+    """Allow `rate` requests per second on average, and at most `burst`
+    requests at once. A rate of None means no limit."""
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available. Return the seconds waited."""
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.paused_until - now
+                if delay <= 0:
+                    if self.rate is None:
+                        return waited
+                    self.tokens = min(self.burst, self.tokens + (
+                                      now - self.updated_at) * self.rate)
+                    self.updated_at = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds):
+        """Stop handing out tokens for a while, e.g. for Retry-After."""
+        with self.lock:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """Token buckets and statistics per host, shared by all the threads
+    sending http requests."""
+
+    STAT_KEYS = ("requests", "retries", "errors", "throttled", "failures",
+                 "wait_seconds", "response_seconds")
+
+    def __init__(self, rate=None, burst=1, backoff_base=1, backoff_max=60):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.host_stats = {}
+        self.configure(rate, burst, backoff_base, backoff_max)
+
+    def configure(self, rate=None, burst=1, backoff_base=1, backoff_max=60):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst
+            self.backoff_base = backoff_base
+            self.backoff_max = backoff_max
+            self.buckets = {}
+
+    def acquire(self, host):
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(self.rate,
+                                                          self.burst)
+        waited = bucket.acquire()
+        self.record(host, requests=1, wait_seconds=waited)
+
+    def pause(self, host, seconds):
+        with self.lock:
+            bucket = self.buckets.get(host)
+        if bucket is not None:
+            bucket.pause(seconds)
+
+    def backoff(self, try_times):
+        """Exponential backoff with full jitter."""
+        cap = min(self.backoff_max, self.backoff_base * 2 ** (try_times - 1))
+        return random.uniform(0, cap)
+
+    def record(self, host, **counters):
+        with self.lock:
+            stats = self.host_stats.get(host)
+            if stats is None:
+                stats = self.host_stats[host] = dict.fromkeys(self.STAT_KEYS, 0)
+            for key, value in counters.items():
+                stats[key] += value
+
+    def stats(self):
+        with self.lock:
+            return {host: dict(stats)
+                    for host, stats in self.host_stats.items()}
+
+
+rate_limiter = RateLimiter()
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def replace_base_url(url, base_url):
+    """Replace the scheme and the host of url with those of base_url."""
+    parts = urllib.parse.urlsplit(url)
+    base = urllib.parse.urlsplit(base_url)
+    return urllib.parse.urlunsplit((base.scheme, base.netloc) + parts[2:])
+
+
+def retry_after(resp):
+    """Return the seconds to wait according to the Retry-After header, or
+    None if there is no valid one."""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        dt = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((dt - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def do_http_request(session, request, timeout=None, max_tries=3,
+                    limiter=None, cache_key=None, ok_status=(200,)):
+    """Send the request with retries. If the session has a response cache,
+    the response is looked up by cache_key, or by the normalized url if
+    cache_key is not given, before sending anything. Only responses of
+    status 200 are cached. If the session has a recorder, responses of
+    status 200 sent by the host are also saved in it. The key is kept in
+    resp.cache_key, see evict_on_error.
+
+    If timeout is None, the read timeout of HttpSession is used, or 5
+    seconds for a plain session."""
+
+    cache = getattr(session, "response_cache", None)
+    if cache is not None:
+        if cache_key is None:
+            cache_key = normalize_url(session.prepare_request(request).url)
+        resp = cache.get(cache_key)
+        if resp is not None:
+            resp.cache_key = cache_key
+            return resp
+
+    if timeout is None:
+        timeout = getattr(session, "read_timeout", 5)
+    limiter = limiter or rate_limiter
     try_times = 0
 
     while True:
         try_times += 1
         prepped = session.prepare_request(request)
+        host = urllib.parse.urlsplit(prepped.url).netloc
+        limiter.acquire(host)
+        start_time = time.monotonic()
         try:
             resp = session.send(prepped, timeout=timeout)
         except (requests.exceptions.RequestException,
                 requests.exceptions.Timeout) as e:
-            if try_times < 3:
+            limiter.record(host, errors=1)
+            if try_times < max_tries:
                 logger.warning("%s-th try failed for %s: %s",
                                try_times, request.url, e)
-                if not isinstance(e, requests.exceptions.Timeout):
-                    time.sleep(3)
+                delay = limiter.backoff(try_times)
             else:
+                limiter.record(host, failures=1)
                 raise DownloadError("http request failed: %s, %s"
                                     % (prepped.url, e))
         else:
-            break
+            limiter.record(host,
+                           response_seconds=time.monotonic() - start_time)
+            if resp.status_code not in RETRY_STATUS or try_times >= max_tries:
+                break
+
+            if resp.status_code in (429, 503):
+                limiter.record(host, throttled=1)
+            delay = retry_after(resp)
+            if delay is None:
+                delay = limiter.backoff(try_times)
+            else:
+                # the host asks to slow down, hold back the other threads too
+                limiter.pause(host, delay)
+            logger.warning("%s-th try got %s for %s, retry in %.1fs",
+                           try_times, resp.status_code, request.url, delay)
 
-    if resp.status_code != 200:
-        raise DownloadError("bad http response: %s, %s",
-                            resp.status_code, resp.url)
+        limiter.record(host, retries=1)
+        time.sleep(delay)
+
+    if resp.status_code not in ok_status:
+        limiter.record(host, failures=1)
+        raise DownloadError("bad http response: %s, %s"
+                            % (resp.status_code, resp.url))
+
+    if resp.status_code == 200:
+        if cache_key is None:
+            cache_key = normalize_url(prepped.url)
+        if cache is not None:
+            cache.put(cache_key, resp)
+        recorder = getattr(session, "recorder", None)
+        if recorder is not None:
+            recorder.put(cache_key, resp)
+        resp.cache_key = cache_key
 
     return resp
+
+
+@contextlib.contextmanager
+def evict_on_error(session, resp):
+    """Remove the response from the cache and the recorder of the session
+    if parsing it in the block raises ParseError, so that a page like a
+    captcha is downloaded again by the retries instead of being replayed."""
+    try:
+        yield resp
+    except ParseError:
+        cache_key = getattr(resp, "cache_key", None)
+        if cache_key is not None:
+            for name in ("response_cache", "recorder"):
+                cache = getattr(session, name, None)
+                if cache is not None:
+                    cache.delete(cache_key)
+            logger.info("evict the response failed to parse: %s", cache_key)
+        raise
@@ -0,0 +1,245 @@
+import os
+import gzip
+import json
+import pickle
+import shutil
+import hashlib
+import collections
+import logging
+import threading
+import urllib.parse
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_url(url):
+    """Lower the scheme and host, drop the default port and the fragment,
+    and sort the query parameters."""
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if ((scheme == "http" and netloc.endswith(":80"))
+       or (scheme == "https" and netloc.endswith(":443"))):
+        netloc = netloc.rsplit(":", 1)[0]
+    query = urllib.parse.urlencode(
+                sorted(urllib.parse.parse_qsl(parts.query,
+                                              keep_blank_values=True)))
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path or "/",
+                                    query, ""))
+
+
+class ResponseCache:
+    """Raw http responses saved in a directory, one gzip file per response.
+
+    Each saved response appends a line to the index file, which is loaded
+    into a dict when the cache is opened, so a lookup never touches the disk
+    until the response is found. A response is written to its file before
+    its index line, so a crash leaves no index line without a file.
+    """
+
+    INDEX_FILE = "index.jsonl"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, self.INDEX_FILE)
+        self.lock = threading.Lock()
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line may be broken by a crash
+                        continue
+                    if entry.get("deleted"):
+                        self.index.pop(entry["key"], None)
+                    else:
+                        self.index[entry["key"]] = entry
+
+    def get(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+        path = os.path.join(self.directory, entry["file"])
+        try:
+            with gzip.open(path, "rb") as f:
+                content = f.read()
+        except OSError as e:
+            logger.warning("load cached response failed: %s, %s", path, e)
+            with self.lock:
+                self.misses += 1
+            return None
+
+        resp = requests.Response()
+        resp.status_code = entry["status"]
+        resp.url = entry["url"]
+        resp.headers = CaseInsensitiveDict(entry["headers"])
+        resp.encoding = entry["encoding"]
+        resp._content = content
+        with self.lock:
+            self.hits += 1
+        logger.debug("%s -> %s", key, path)
+        return resp
+
+    def put(self, key, resp):
+        file_name = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".gz"
+        path = os.path.join(self.directory, file_name)
+        tmp_path = "%s.%s.tmp" % (path, threading.get_ident())
+        with gzip.open(tmp_path, "wb") as f:
+            f.write(resp.content)
+        os.replace(tmp_path, path)
+
+        entry = {"key": key,
+                 "file": file_name,
+                 "status": resp.status_code,
+                 "url": resp.url,
+                 "headers": dict(resp.headers),
+                 "encoding": resp.encoding}
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self.index[key] = entry
+
+    def delete(self, key):
+        """Remove the response of the key by appending a line marking it
+        deleted to the index file. The response file is left to be
+        overwritten by the next put of the key."""
+        line = json.dumps({"key": key, "deleted": True},
+                          ensure_ascii=False) + "\n"
+        with self.lock:
+            if self.index.pop(key, None) is None:
+                return
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+class CachedSession:
+    """Wrap a http session with a response cache. Everything else is
+    delegated to the wrapped session, so the wrapped one can be shared."""
+
+    def __init__(self, session, response_cache):
+        self.session = session
+        self.response_cache = response_cache
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+class ParseCache:
+    """Results of the parsers, keyed by the name and the version of the
+    parser and the hash of the parsed content and arguments.
+
+    At most max_size results are kept in memory, the least recently used
+    one is dropped first. If a directory is given, results are also saved
+    there, one pickle file per result under a sub directory of the parser
+    and its version. Entries of other versions of a parser are removed when
+    the parser is first used, so bumping the version invalidates them.
+    """
+
+    def __init__(self, max_size=1024, directory=None):
+        self.max_size = max_size
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+        self.checked = set()
+        self.hits = 0
+        self.misses = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(name, version, content, encoding, args):
+        h = hashlib.sha1(content)
+        h.update(repr((encoding, args)).encode("utf-8"))
+        return name, str(version), h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            data = self.results.get(key)
+            if data is not None:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return pickle.loads(data)
+
+        data = self._load(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self._remember(key, data)
+            self.hits += 1
+        return pickle.loads(data)
+
+    def put(self, key, result):
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self._remember(key, data)
+        self._save(key, data)
+
+    def _remember(self, key, data):
+        self.results[key] = data
+        self.results.move_to_end(key)
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
+
+    def _path(self, key):
+        name, version, digest = key
+        return os.path.join(self.directory, name, version, digest + ".pickle")
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        self._check_version(*key[:2])
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning("load parse result failed: %s, %s",
+                           self._path(key), e)
+            return None
+
+    def _save(self, key, data):
+        if self.directory is None:
+            return
+        self._check_version(*key[:2])
+        path = self._path(key)
+        tmp_path = "%s.%s.tmp" % (path, threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("save parse result failed: %s, %s", path, e)
+
+    def _check_version(self, name, version):
+        with self.lock:
+            if (name, version) in self.checked:
+                return
+            self.checked.add((name, version))
+
+        parser_dir = os.path.join(self.directory, name)
+        if not os.path.isdir(parser_dir):
+            return
+        for old_version in os.listdir(parser_dir):
+            if old_version != version:
+                logger.info("remove parse results of %s version %s",
+                            name, old_version)
+                shutil.rmtree(os.path.join(parser_dir, old_version),
+                              ignore_errors=True)
@@ -0,0 +1,404 @@
+import re
+import time
+import logging
+import collections
+import threading
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from bs4 import BeautifulSoup
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+from ..exceptions import ParseError
+
+
+logger = logging.getLogger(__name__)
+
+
+class Node:
+    """An element of a parsed html document. The parsers use only the
+    methods below, so that they work with any backend. The methods follow
+    their namesakes in BeautifulSoup, and are implemented by each backend:
+
+    - find(tag, class_=None): the first descendant of the tag and with all
+      the classes in class_, or None.
+    - find_all(tag, class_=None, recursive=True, string=None): the matched
+      descendants, or children if not recursive. If string is given, only
+      the ones whose string is in it.
+    - find_next(): the next element in the document, or None.
+    - get(name, default=None): the attribute.
+    - text: the text of the element and its descendants.
+    - string: the text if the element contains nothing but text, the
+      string of its only child if it has one, otherwise None.
+    """
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+
+class Bs4Node(Node):
+
+    def __init__(self, element):
+        self.element = element
+
+    @classmethod
+    def wrap(cls, element):
+        return None if element is None else cls(element)
+
+    def find(self, tag, class_=None):
+        if class_ is None:
+            return self.wrap(self.element.find(tag))
+        return self.wrap(self.element.find(tag, class_=class_))
+
+    def find_all(self, tag, class_=None, recursive=True, string=None):
+        kwargs = {"recursive": recursive}
+        if class_ is not None:
+            kwargs["class_"] = class_
+        if string is not None:
+            kwargs["string"] = string
+        return [Bs4Node(e) for e in self.element.find_all(tag, **kwargs)]
+
+    def find_next(self):
+        return self.wrap(self.element.findNext())
+
+    def get(self, name, default=None):
+        return self.element.get(name, default)
+
+    @property
+    def text(self):
+        return self.element.get_text()
+
+    @property
+    def string(self):
+        string = self.element.string
+        return None if string is None else str(string)
+
+
+class LxmlNode(Node):
+
+    def __init__(self, element):
+        self.element = element
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def xpath(axis, tag, class_, first=False):
+        condition = "".join(
+            "[contains(concat(' ', normalize-space(@class), ' '), ' %s ')]"
+            % c for c in (class_ or "").split())
+        path = "%s%s%s" % (axis, tag, condition)
+        if first:
+            path = "(%s)[1]" % path
+        return etree.XPath(path)
+
+    def find(self, tag, class_=None):
+        elements = self.xpath(".//", tag, class_, first=True)(self.element)
+        return LxmlNode(elements[0]) if elements else None
+
+    def find_all(self, tag, class_=None, recursive=True, string=None):
+        axis = ".//" if recursive else "./"
+        elements = self.xpath(axis, tag, class_)(self.element)
+        nodes = [LxmlNode(e) for e in elements]
+        if string is not None:
+            strings = [string] if isinstance(string, str) else string
+            nodes = [n for n in nodes if n.string in strings]
+        return nodes
+
+    def find_next(self):
+        for e in self.element.iterdescendants(etree.Element):
+            return LxmlNode(e)
+        elements = self.element.xpath("following::*[1]")
+        return LxmlNode(elements[0]) if elements else None
+
+    def get(self, name, default=None):
+        return self.element.get(name, default)
+
+    @property
+    def text(self):
+        return str(self.element.xpath("string()"))
+
+    @property
+    def string(self):
+        children = [e for e in self.element if isinstance(e.tag, str)]
+        if not children:
+            return self.element.text
+        elif len(children) == 1 and not (self.element.text
+                                         or children[0].tail):
+            return LxmlNode(children[0]).string
+        else:
+            return None
+
+
+class Bs4Backend:
+    """BeautifulSoup with the html.parser of the standard library."""
+
+    name = "bs4"
+    # building the tree is the most of the cost
+    use_regions = True
+
+    def parse(self, text):
+        return Bs4Node(BeautifulSoup(text, "html.parser"))
+
+
+class LxmlBackend:
+    """The html parser of libxml2, queried by XPath."""
+
+    name = "lxml"
+    # as fast as scanning for the regions
+    use_regions = False
+
+    def parse(self, text):
+        try:
+            root = lxml.html.document_fromstring(text)
+        except ValueError:
+            # a str with an xml encoding declaration is refused
+            parser = lxml.html.HTMLParser(encoding="utf-8")
+            root = lxml.html.document_fromstring(text.encode("utf-8"),
+                                                 parser=parser)
+        except etree.ParserError as e:
+            raise ParseError("parse html failed: %s" % e)
+        return LxmlNode(root)
+
+
+BACKENDS = {"bs4": Bs4Backend()}
+if lxml is not None:
+    BACKENDS["lxml"] = LxmlBackend()
+
+backend = BACKENDS["bs4"]
+
+
+def set_backend(name):
+    """Select the backend used by parse_html. lxml falls back to bs4 if it
+    is not installed."""
+    global backend
+    if name == "lxml" and name not in BACKENDS:
+        logger.warning("lxml is not installed, use bs4 to parse html")
+        name = "bs4"
+    elif name not in BACKENDS:
+        raise ValueError("unknown parser backend: %s" % name)
+    backend = BACKENDS[name]
+
+
+class Region:
+    """An element in the raw html, found by its tag and one of its classes,
+    or a few classes in the order of the class attribute."""
+
+    def __init__(self, tag, class_):
+        self.tag = tag
+        self.class_ = class_
+        self.start_pattern = re.compile(
+            r"""<%s\b[^>]*\bclass\s*=\s*["']?[^"'>]*?(?<![\w-])%s(?![\w-])"""
+            % (tag, re.escape(class_)), re.IGNORECASE)
+        self.tag_pattern = re.compile(r"<(/?)%s\b" % tag, re.IGNORECASE)
+
+    def find(self, text):
+        """Return the start and the end of the element in text, or None."""
+        m = self.start_pattern.search(text)
+        if m is None:
+            return None
+
+        # count the start and end tags of the same name
+        depth = 0
+        for m_tag in self.tag_pattern.finditer(text, m.start()):
+            if not m_tag.group(1):
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 0:
+                end = text.find(">", m_tag.end())
+                return None if end < 0 else (m.start(), end + 1)
+        return None
+
+
+def slice_regions(text, regions):
+    """Return a document made of the regions only, in the order of the
+    original one, or None if any of them is missing."""
+    spans = []
+    for region in regions:
+        span = region.find(text)
+        if span is None:
+            return None
+        spans.append(span)
+
+    parts = []
+    last_end = 0
+    for start, end in sorted(spans):
+        if start < last_end:
+            # inside the last region
+            continue
+        parts.append(text[start:end])
+        last_end = end
+    return "<html><body>%s</body></html>" % "".join(parts)
+
+
+# counted by the parsers of the current process
+counters = collections.Counter()
+counters_lock = threading.Lock()
+
+
+def count(name, n=1):
+    with counters_lock:
+        counters[name] += n
+
+
+def _parse_in_child(func, page, *args):
+    """Parse the page in a process of ParsePool, and return the result
+    together with the counters added by parsing, which are merged into the
+    counters of the parent. A process parses one page at a time."""
+    with counters_lock:
+        counters.clear()
+    result = func(page, *args)
+    with counters_lock:
+        return result, dict(counters)
+
+
+def parse_html(text, regions=None):
+    """Parse the html text by the selected backend.
+
+    If regions are given and the backend is slow enough for it, only they
+    are parsed, which saves time and memory when the parser needs a small
+    part of a large page. The whole document is parsed if any of them is
+    missing.
+    """
+    if regions and backend.use_regions:
+        sliced = slice_regions(text, regions)
+        if sliced is None:
+            count("region_fallbacks")
+        else:
+            count("region_parses")
+            text = sliced
+    return backend.parse(text)
+
+
+def parser_version(version):
+    """Mark a parse function with the version of its output. Results of the
+    marked functions are cached by ParsePool, so bump the version whenever
+    the output of the function changes."""
+    def decorator(func):
+        func.parser_version = version
+        return func
+    return decorator
+
+
+class Page:
+    """The part of a response needed by the parsers, which can be sent to
+    another process."""
+
+    def __init__(self, content, encoding, url):
+        self.content = content
+        self.encoding = encoding
+        self.url = url
+
+    @classmethod
+    def from_response(cls, resp):
+        return cls(resp.content, resp.encoding or resp.apparent_encoding,
+                   resp.url)
+
+    @property
+    def text(self):
+        return str(self.content, self.encoding or "utf-8", errors="replace")
+
+
+class ParsePool:
+    """Parse pages in a process pool, so that parsing in many threads is not
+    serialized by the GIL.
+
+    The parse function must be picklable, i.e. a module level function, a
+    static method or a class method, and it must return plain data. Pages
+    smaller than min_size are parsed in the current process, because for
+    them sending the page costs more than it saves. With no processes
+    everything is parsed in the current process.
+
+    The number of pages, bytes and seconds spent are counted for each
+    backend.
+
+    If a ParseCache is given, the results of the functions marked by
+    parser_version are looked up there before parsing.
+    """
+
+    def __init__(self, processes=0, min_size=65536, cache=None):
+        self.lock = threading.Lock()
+        self.executor = None
+        self._stats = {}
+        self.configure(processes, min_size, cache)
+
+    def configure(self, processes=0, min_size=65536, cache=None):
+        self.shutdown()
+        self.processes = processes
+        self.min_size = min_size
+        self.cache = cache
+
+    def parse(self, func, resp, *args):
+        version = getattr(func, "parser_version", None)
+        if self.cache is None or version is None:
+            return self._timed_parse(func, resp, *args)
+
+        key = self.cache.key(func.__qualname__, version, resp.content,
+                             resp.encoding, args)
+        result = self.cache.get(key)
+        if result is None:
+            result = self._timed_parse(func, resp, *args)
+            if result is not None:
+                self.cache.put(key, result)
+        return result
+
+    def _timed_parse(self, func, resp, *args):
+        start_time = time.monotonic()
+        try:
+            return self._parse(func, resp, *args)
+        finally:
+            self.record(backend.name, len(resp.content),
+                        time.monotonic() - start_time)
+
+    def _parse(self, func, resp, *args):
+        if not self.processes or len(resp.content) < self.min_size:
+            return func(resp, *args)
+
+        with self.lock:
+            if self.executor is None:
+                # do not fork a process with running threads
+                context = multiprocessing.get_context("spawn")
+                self.executor = ProcessPoolExecutor(
+                                    self.processes, mp_context=context,
+                                    initializer=set_backend,
+                                    initargs=(backend.name,))
+        future = self.executor.submit(_parse_in_child, func,
+                                      Page.from_response(resp), *args)
+        result, child_counters = future.result()
+        with counters_lock:
+            counters.update(child_counters)
+        return result
+
+    def record(self, name, size, seconds):
+        with self.lock:
+            stats = self._stats.setdefault(name, {"pages": 0, "bytes": 0,
+                                                  "seconds": 0})
+            stats["pages"] += 1
+            stats["bytes"] += size
+            stats["seconds"] += seconds
+
+    def stats(self):
+        with self.lock:
+            result = {}
+            for name, stats in self._stats.items():
+                result[name] = dict(stats)
+                if stats["seconds"] > 0:
+                    result[name]["pages_per_second"] = (stats["pages"]
+                                                        / stats["seconds"])
+            return result
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+
+parse_pool = ParsePool()
@@ -0,0 +1,119 @@
+import time
+import random
+import base64
+import logging
+import binascii
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .cache import ResponseCache
+
+
+logger = logging.getLogger(__name__)
+
+# headers describing the transfer of the original response, the recorded
+# content is already decoded.
+SKIP_HEADERS = {"connection", "keep-alive", "transfer-encoding",
+                "content-encoding", "content-length"}
+
+
+def replay_key(url):
+    """Return the key to look up a recorded response by the path and the
+    query of the url, so that the host does not matter.
+
+    fangdi.com.cn community and presale pages are recorded by outer_id,
+    because their projectID changes every time, see CommunityFD._fd_tmp_id.
+    """
+    parts = urllib.parse.urlsplit(url)
+    params = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    project_ids = [v for k, v in params if k == "projectID"]
+    if project_ids:
+        try:
+            outer_id = base64.b64decode(project_ids[0]).decode("ascii")
+        except (binascii.Error, UnicodeDecodeError):
+            pass
+        else:
+            params = [("outer_id", outer_id.split("|")[0])]
+    query = urllib.parse.urlencode(sorted(params))
+    return "%s?%s" % (parts.path or "/", query)
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(0, 2 * server.latency))
+
+        if server.error_rate and random.random() < server.error_rate:
+            self.send_error(503)
+            return
+
+        key = server.routes.get(replay_key(self.path))
+        resp = None if key is None else server.response_cache.get(key)
+        if resp is None:
+            self.send_error(404)
+            return
+
+        etag = resp.headers.get("ETag")
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(resp.status_code)
+        for name, value in resp.headers.items():
+            if name.lower() not in SKIP_HEADERS:
+                self.send_header(name, value)
+        if self.close_connection:
+            # asked by the client, tell it the connection is not reusable
+            self.send_header("Connection", "close")
+        self.send_header("Content-Length", str(len(resp.content)))
+        self.end_headers()
+        self.write_body(resp.content)
+
+    def write_body(self, content):
+        throughput = self.server.throughput
+        if not throughput:
+            self.wfile.write(content)
+            return
+
+        chunk_size = 8192
+        for i in range(0, len(content), chunk_size):
+            chunk = content[i:i+chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / throughput)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """A local stand-in for lianjia.com and fangdi.com.cn, serving the
+    responses recorded in a directory of ResponseCache.
+
+    Faults can be injected for load tests: a random latency with the given
+    mean in seconds, a rate of 503 responses, and the throughput of each
+    response in bytes per second.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, address=("127.0.0.1", 8000), latency=0,
+                 error_rate=0, throughput=None):
+        self.response_cache = ResponseCache(directory)
+        self.routes = {replay_key(key): key
+                       for key in self.response_cache.index}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throughput = throughput
+        ThreadingHTTPServer.__init__(self, address, ReplayHandler)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%s" % (host, port)
@@ -64,35 +64,13 @@ def community():
     return jsonify(data=data)
 
 
-joined_table_1 = (
-    HouseRecordLJ.__table__
-    .join(HouseLJ.__table__,
-          HouseRecordLJ.house_id == HouseLJ.id)
-    .join(Community.__table__,
-          HouseRecordLJ.community_id == Community.id)
-    .join(District.__table__,
-          Community.district_id == District.id)
-    .join(Area.__table__,
-          Community.area_id == Area.id)
-    .join(BatchJob.__table__,
-          (HouseRecordLJ.batch_type == BatchJob.type) & (
-           HouseRecordLJ.batch_number == BatchJob.batch_number))
-)
-
-
 @app.route('/api/avg_price', methods=['GET'])
 @cached()
 def avg_price():
     dt_end = datetime.now()
     dt_begin = dt_end - timedelta(hours=365*24*float(request.args["period"]))
 
-    query = (select([HouseRecordLJ.community_id,
-                     func.date(BatchJobLJ.created_at).label("created_at"),
-                     (500/HouseLJ.area).label("area"),
-                     (HouseRecordLJ.price/HouseLJ.area).label("price")])
-             .select_from(joined_table_1)
-             .where((HouseRecordLJ.price+HouseLJ.area).isnot(None))
-             .where(BatchJobLJ.created_at.between(dt_begin, dt_end)))
+    query = HouseRecordLJ.avg_price_query(dt_begin, dt_end)
 
     if request.args.get("community_id", None):
         query = query.where(Community.id == request.args["community_id"])
@@ -142,11 +120,9 @@ def community_detail():
     date_str = func.date_format(HouseLJ.date_to_market, '%Y-%m-%d')
     col_date_to_market = case([(HouseLJ.date_to_market.is_(None), "未知")],
                               else_=date_str).label(HouseLJ.date_to_market.name)
-    query = (select([col_date_to_market, HouseLJ.area, HouseLJ.price_origin,
-                     HouseLJ.price])
-             .where(HouseLJ.community_id == community_id)
-             .where(HouseLJ.available.is_(True))
-             .order_by(HouseLJ.area, HouseLJ.price))
+    query = HouseLJ.available_query(community_id,
+                                    [col_date_to_market, HouseLJ.area,
+                                     HouseLJ.price_origin, HouseLJ.price])
     info_raw = app.db_engine.execute(query).fetchall()
     house_list = [dict(r) for r in info_raw]
 
@@ -16,4 +16,5 @@ setup(
     install_requires=['alembic==0.9.2', 'requests', 'SQLAlchemy', 'PyMySQL',
                       'flask', 'flask_admin', 'bs4==0.0.1', "blinker",
                       "pandas", "gunicorn"],
+    extras_require={"lxml": ["lxml"]},
 )
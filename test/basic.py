@@ -1,9 +1,47 @@
 
+import os
+import time
 import types
 import shutil
 import unittest
+import threading
+import email.utils
 
-from house_tracker import db, config, models
+import requests
+
+from house_tracker import db, config, models, explain, utils
+from house_tracker.exceptions import DownloadError, ParseError
+from house_tracker.utils.cache import (ResponseCache, ParseCache, CachedSession,
+                                      normalize_url)
+from house_tracker.utils.replay import ReplayServer
+from house_tracker.utils import parser
+
+
+class StubSession(requests.Session):
+    """A session returning the given responses in order instead of
+    sending the requests. An exception in the responses is raised."""
+
+    def __init__(self, responses):
+        requests.Session.__init__(self)
+        self.responses = list(responses)
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        resp = self.responses.pop(0)
+        if isinstance(resp, Exception):
+            raise resp
+        resp.url = request.url
+        return resp
+
+
+def stub_response(status_code, content=b"", headers=None):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp.headers.update(headers or {})
+    resp.encoding = "utf-8"
+    resp._content = content
+    return resp
 
 
 class Test(unittest.TestCase):
@@ -97,3 +135,368 @@ class Test(unittest.TestCase):
                         job_2.parameters.get("total_page", "no data"))
         self.assertTrue(job_2.parameters.get("next_page") == total_page+1,
                         job_2.parameters.get("next_page", "no data"))
+
+    def test_4(self):
+        total_page = 5
+        search_func = lambda http_session, next_page: {"total_page": total_page,
+                                                       "page": next_page}
+        job = types.SimpleNamespace(parameters={}, http_session=None)
+
+        with models.PagesIterator(job, search_func, prefetch=2) as pages:
+            page_list = [content["page"] for content in pages]
+        self.assertTrue(page_list == list(range(1, total_page+1)), page_list)
+        self.assertTrue(job.parameters.get("next_page") == total_page+1,
+                        job.parameters.get("next_page", "no data"))
+
+        # no more than prefetch pages are downloaded ahead of the one taken
+        ahead = []
+
+        def search_func(http_session, next_page):
+            taken = job.parameters.get("next_page", 1) - 1
+            ahead.append(next_page - taken)
+            return {"total_page": total_page, "page": next_page}
+
+        job = types.SimpleNamespace(parameters={}, http_session=None)
+        with models.PagesIterator(job, search_func, prefetch=2) as pages:
+            page_list = [content["page"] for content in pages]
+        self.assertTrue(page_list == list(range(1, total_page+1)), page_list)
+        self.assertTrue(max(ahead) <= 2, ahead)
+
+    def test_5(self):
+        cache_dir = os.path.join(self.root, "response_cache")
+        cache = ResponseCache(cache_dir)
+        self.assertTrue(cache.get("http://example.com/") is None)
+
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = "http://example.com/"
+        resp.encoding = "utf-8"
+        resp._content = "测试".encode("utf-8")
+        cache.put("http://example.com/", resp)
+
+        # load index from disk
+        cache = ResponseCache(cache_dir)
+        cached = cache.get("http://example.com/")
+        self.assertTrue(cached is not None)
+        self.assertTrue(cached.text == "测试", cached.text)
+        self.assertTrue(cached.url == resp.url)
+        self.assertTrue(normalize_url("HTTP://Example.com:80/?b=1&a=2#x")
+                        == "http://example.com/?a=2&b=1")
+
+    def test_6(self):
+        record_dir = os.path.join(self.root, "record")
+        cache = ResponseCache(record_dir)
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.url = "http://www.fangdi.com.cn/Presell.asp"
+        resp.headers["Content-Type"] = "text/html; charset=gbk"
+        resp._content = "预售".encode("gbk")
+        cache.put("http://www.fangdi.com.cn/Presell.asp?outer_id=10", resp)
+
+        server = ReplayServer(record_dir, ("127.0.0.1", 0))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            req = models.CommunityFD._fd_presale_request(1, "10", "名称")
+            req.url = req.url.replace("http://www.fangdi.com.cn",
+                                      server.base_url)
+            with requests.Session() as session:
+                replayed = session.send(session.prepare_request(req))
+                self.assertTrue(replayed.status_code == 200)
+                self.assertTrue(replayed.text == "预售", replayed.text)
+
+                missing = session.get(server.base_url + "/Presell.asp")
+                self.assertTrue(missing.status_code == 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_7(self):
+        """parser backends give the same result on the fixtures"""
+        fixture_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+
+        def load(name, encoding):
+            resp = requests.Response()
+            resp.status_code = 200
+            resp.url = "http://fixture/%s" % name
+            resp.encoding = encoding
+            with open(os.path.join(fixture_dir, name), "rb") as f:
+                resp._content = f.read()
+            return resp
+
+        def parse_all():
+            return [
+                models.CommunityLJ._lj_parse(load("lj_community.html",
+                                                  "utf-8"), 1, 30),
+                models.HouseLJ._lj_parse(load("lj_house.html", "utf-8"),
+                                         "107000000001"),
+                models.DistrictFD._fd_parse(load("fd_district.html", "gbk"),
+                                            1, "杨浦区"),
+                models.CommunityFD._fd_parse_presale(
+                    load("fd_presale.html", "gbk"), 1),
+                models.CommunityFD._fd_parse_community(
+                    load("fd_community.html", "gbk"), "8629")]
+
+        old_backend = parser.backend
+        try:
+            parser.set_backend("bs4")
+            expected = parse_all()
+            self.assertTrue(len(expected[0]["houses_info"]) == 30)
+            self.assertTrue(expected[2]["total_page"] == 16)
+            for name in parser.BACKENDS:
+                parser.set_backend(name)
+                self.assertTrue(parse_all() == expected, name)
+        finally:
+            parser.backend = old_backend
+
+    def test_8(self):
+        text = ('<div class="a"><div class="panel x"><div>1</div><span>2'
+                '</span></div><ul class="list"><li>3</li></ul></div>')
+        panel = parser.Region("div", "panel")
+        start, end = panel.find(text)
+        self.assertTrue(text[start:end] == '<div class="panel x"><div>1'
+                                           '</div><span>2</span></div>')
+
+        sliced = parser.slice_regions(text, [parser.Region("ul", "list"),
+                                             panel])
+        self.assertTrue(sliced.index("panel") < sliced.index("list"))
+        self.assertTrue(parser.slice_regions(
+            text, [panel, parser.Region("div", "missing")]) is None)
+
+    def test_9(self):
+        """regex fast path of house detail"""
+        path = os.path.join(os.path.dirname(__file__), "fixtures",
+                            "lj_house.html")
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        info = models.HouseLJ._lj_parse_fast(text, "107000000001")
+        self.assertTrue(info is not None)
+
+        resp = requests.Response()
+        resp.url = "http://fixture/lj_house.html"
+        resp.encoding = "utf-8"
+        resp._content = text.replace('class="count"', 'class="number"'
+                                     ).encode("utf-8")
+        fallbacks = parser.counters["lj_detail_fallbacks"]
+        try:
+            models.HouseLJ._lj_parse(resp, "107000000001")
+        except AttributeError:
+            # the tree does not know the new layout either
+            pass
+        self.assertTrue(parser.counters["lj_detail_fallbacks"]
+                        == fallbacks + 1)
+
+        # the same as the tree, which is used if the fast path fails
+        resp._content = text.replace('<span class="label">',
+                                     '<span class="label" >').encode("utf-8")
+        self.assertTrue(info == models.HouseLJ._lj_parse(resp, "107000000001"))
+        self.assertTrue(parser.counters["lj_detail_fallbacks"]
+                        == fallbacks + 2)
+
+    def test_10(self):
+        """parse result cache"""
+        path = os.path.join(os.path.dirname(__file__), "fixtures",
+                            "fd_presale.html")
+        resp = requests.Response()
+        resp.url = "http://fixture/fd_presale.html"
+        resp.encoding = "gbk"
+        with open(path, "rb") as f:
+            resp._content = f.read()
+
+        calls = []
+
+        @parser.parser_version(1)
+        def parse(resp, community_id):
+            calls.append(community_id)
+            return models.CommunityFD._fd_parse_presale(resp, community_id)
+
+        directory = os.path.join(self.root, "parse_cache")
+        pool = parser.ParsePool(cache=ParseCache(1, directory))
+        result = pool.parse(parse, resp, 1)
+        self.assertTrue(len(result) == 8)
+        self.assertTrue(pool.parse(parse, resp, 1) == result)
+        self.assertTrue(calls == [1])
+        # other arguments, other result
+        pool.parse(parse, resp, 2)
+        self.assertTrue(calls == [1, 2])
+        self.assertTrue(len(pool.cache.results) == 1)
+
+        # saved on disk
+        pool = parser.ParsePool(cache=ParseCache(10, directory))
+        self.assertTrue(pool.parse(parse, resp, 1) == result)
+        self.assertTrue(calls == [1, 2])
+
+        # a new version invalidates the old results
+        parse.parser_version = 2
+        pool.parse(parse, resp, 1)
+        self.assertTrue(calls == [1, 2, 1])
+        self.assertTrue(os.listdir(os.path.join(directory,
+                                                parse.__qualname__))
+                        == ["2"])
+
+    def test_11(self):
+        """test the plans of the queries"""
+        with db.engine.connect() as connection:
+            results = explain.explain_all(connection)
+        self.assertTrue(len(results) == len(explain.QUERIES))
+        for name, plan, scans in results:
+            self.assertTrue(len(plan) > 0, name)
+            self.assertTrue(not scans, "%s: %s" % (name, scans))
+
+        plan = [{"table": "house", "type": "ALL"},
+                {"table": "community", "type": "ref"}]
+        self.assertTrue(explain.full_scans("mysql", plan) == ["house"])
+        plan = [{"detail": "SCAN house"},
+                {"detail": "SEARCH community USING INDEX ix (type=?)"}]
+        self.assertTrue(explain.full_scans("sqlite", plan) == ["house"])
+
+    def test_12(self):
+        """test the token bucket, backoff and Retry-After"""
+        bucket = utils.TokenBucket()
+        self.assertTrue(bucket.acquire() == 0)
+
+        bucket = utils.TokenBucket(rate=50, burst=2)
+        self.assertTrue(bucket.acquire() == 0 and bucket.acquire() == 0)
+        waited = bucket.acquire()
+        self.assertTrue(0 < waited <= 0.05, waited)
+        bucket.pause(0.05)
+        self.assertTrue(bucket.acquire() >= 0.04)
+
+        limiter = utils.RateLimiter(backoff_base=1, backoff_max=4)
+        for try_times in range(1, 10):
+            self.assertTrue(0 <= limiter.backoff(try_times)
+                            <= min(4, 2 ** (try_times - 1)))
+
+        self.assertTrue(utils.retry_after(stub_response(429)) is None)
+        self.assertTrue(utils.retry_after(
+            stub_response(429, headers={"Retry-After": "2"})) == 2)
+        self.assertTrue(utils.retry_after(
+            stub_response(429, headers={"Retry-After": "soon"})) is None)
+        date = email.utils.formatdate(time.time() + 30, usegmt=True)
+        seconds = utils.retry_after(stub_response(
+            503, headers={"Retry-After": date}))
+        self.assertTrue(25 < seconds <= 30, seconds)
+
+    def test_13(self):
+        """test the retries of do_http_request with a stubbed session"""
+        request = requests.Request("GET", "http://example.com/a")
+
+        # throttled, waiting for Retry-After
+        session = StubSession([
+            stub_response(429, headers={"Retry-After": "0.05"}),
+            stub_response(200, b"ok")])
+        limiter = utils.RateLimiter(backoff_base=0.01)
+        start_time = time.monotonic()
+        resp = utils.do_http_request(session, request, limiter=limiter)
+        self.assertTrue(resp.content == b"ok")
+        self.assertTrue(time.monotonic() - start_time >= 0.05)
+        stats = limiter.stats()["example.com"]
+        self.assertTrue(stats["requests"] == 2 and stats["retries"] == 1
+                        and stats["throttled"] == 1, stats)
+
+        # connection errors and bad status are retried with backoff
+        session = StubSession([requests.exceptions.ConnectionError("reset"),
+                               stub_response(502), stub_response(200)])
+        limiter = utils.RateLimiter(backoff_base=0.01)
+        resp = utils.do_http_request(session, request, limiter=limiter)
+        self.assertTrue(resp.status_code == 200)
+        stats = limiter.stats()["example.com"]
+        self.assertTrue(stats["errors"] == 1 and stats["retries"] == 2,
+                        stats)
+
+        # give up after max_tries
+        session = StubSession([stub_response(503), stub_response(503)])
+        limiter = utils.RateLimiter(backoff_base=0.01)
+        with self.assertRaises(DownloadError):
+            utils.do_http_request(session, request, max_tries=2,
+                                  limiter=limiter)
+        self.assertTrue(not session.responses)
+        self.assertTrue(limiter.stats()["example.com"]["failures"] == 1)
+
+    def test_14(self):
+        """a response failing to parse is evicted from the cache"""
+        with open(os.path.join(os.path.dirname(__file__), "fixtures",
+                               "lj_community.html"), "rb") as f:
+            page = f.read()
+        cache_dir = os.path.join(self.root, "evict")
+        session = CachedSession(
+            StubSession([stub_response(200, b"<html>captcha</html>"),
+                         stub_response(200, page)]),
+            ResponseCache(cache_dir))
+        key = normalize_url(models.CommunityLJ.SEARCH_URL % (1, "5011"))
+
+        with self.assertRaises(ParseError):
+            models.CommunityLJ._lj_search("5011", session, 1, 30)
+        self.assertTrue(session.response_cache.get(key) is None)
+        self.assertTrue(ResponseCache(cache_dir).get(key) is None)
+
+        # downloaded again, and cached once parsed
+        info = models.CommunityLJ._lj_search("5011", session, 1, 30)
+        self.assertTrue(len(info["houses_info"]) == 30)
+        self.assertTrue(len(session.session.sent) == 2)
+        self.assertTrue(ResponseCache(cache_dir).get(key) is not None)
+
+    def test_15(self):
+        """test the connection pool of HttpSession"""
+        record_dir = os.path.join(self.root, "pool")
+        ResponseCache(record_dir).put("http://example.com/a",
+                                      stub_response(200, b"a"))
+        server = ReplayServer(record_dir, ("127.0.0.1", 0))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        host = "%s:%s" % server.server_address[:2]
+        try:
+            session = utils.HttpSession(pool_connections=2, pool_maxsize=3,
+                                        connect_timeout=1, read_timeout=2)
+            adapter = session.get_adapter(server.base_url)
+            self.assertTrue(adapter._pool_connections == 2)
+            self.assertTrue(adapter._pool_maxsize == 3)
+            self.assertTrue(adapter._pool_block)
+            with session:
+                for _ in range(3):
+                    resp = session.get(server.base_url + "/a")
+                    self.assertTrue(resp.content == b"a")
+                stats = session.pool_stats()
+            self.assertTrue(stats[host] == {"requests": 3, "connections": 1,
+                                            "reused": 2}, stats)
+
+            # the server closes the connection after each request
+            with utils.HttpSession(keep_alive=False) as session:
+                for _ in range(3):
+                    resp = session.get(server.base_url + "/a")
+                    self.assertTrue(resp.headers["Connection"] == "close")
+                    self.assertTrue(resp.content == b"a")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_16(self):
+        """counters of the pages parsed by the process pool"""
+        fixture_dir = os.path.join(os.path.dirname(__file__), "fixtures")
+        pages = []
+        for name, func, args in (
+                ("lj_community.html", models.CommunityLJ._lj_parse, (1, 30)),
+                ("lj_house.html", models.HouseLJ._lj_parse,
+                 ("107000000001",))):
+            with open(os.path.join(fixture_dir, name), "rb") as f:
+                pages.append((func, stub_response(200, f.read()), args))
+
+        def parse_all(parse):
+            before = parser.counters.copy()
+            results = [parse(func, resp, *args) for func, resp, args in pages]
+            return results, parser.counters - before
+
+        old_backend = parser.backend
+        pool = parser.ParsePool(processes=1, min_size=0)
+        try:
+            # bs4 parses the regions
+            parser.set_backend("bs4")
+            expected, expected_counters = parse_all(
+                lambda func, resp, *args: func(resp, *args))
+            results, counters = parse_all(pool.parse)
+        finally:
+            pool.shutdown()
+            parser.backend = old_backend
+        self.assertTrue(results == expected)
+        self.assertTrue(counters["region_parses"] > 0, counters)
+        self.assertTrue(counters == expected_counters, counters)
@@ -0,0 +1,171 @@
+"""Benchmark of the parsers over the pages in test/fixtures.
+
+    python -m test.benchmark [-n 100] [-b lxml] [-o result.json]
+
+Each parser is run over each of its pages listed in fixtures/index.json,
+with every parser backend unless one is given. The result is written as
+json, so that two runs can be compared. Peak allocation is measured by
+tracemalloc in a separate run, and covers only the memory allocated by
+python, not by libxml2.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+import requests
+
+from house_tracker.models import (CommunityLJ, HouseLJ, DistrictFD,
+                                  CommunityFD, LandSoldRecord)
+from house_tracker.utils import parser
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def lj_parse_transaction_info(resp):
+    raw_div = parser.parse_html(resp.text).find("div", class_="transaction")
+    return lambda: HouseLJ.lj_parse_transaction_info(raw_div)
+
+
+def parse_web_page(resp, record_no):
+    record = LandSoldRecord(record_no=record_no)
+    return lambda: record.parse_web_page(resp.text)
+
+
+# name: (function returning the call to be measured, uses parser backend)
+PARSERS = {
+    "CommunityLJ._lj_parse":
+        (lambda resp, *args: lambda: CommunityLJ._lj_parse(resp, *args),
+         True),
+    # the two paths of HouseLJ._lj_parse
+    "HouseLJ._lj_parse_fast":
+        (lambda resp, *args: lambda: HouseLJ._lj_parse_fast(resp.text, *args),
+         False),
+    "HouseLJ._lj_parse_tree":
+        (lambda resp, *args: lambda: HouseLJ._lj_parse_tree(resp, *args),
+         True),
+    "HouseLJ.lj_parse_transaction_info": (lj_parse_transaction_info, True),
+    "DistrictFD._fd_parse":
+        (lambda resp, *args: lambda: DistrictFD._fd_parse(resp, *args), True),
+    "CommunityFD._fd_parse_presale":
+        (lambda resp, *args: lambda: CommunityFD._fd_parse_presale(resp,
+                                                                   *args),
+         True),
+    "CommunityFD._fd_parse_community":
+        (lambda resp, *args: lambda: CommunityFD._fd_parse_community(resp,
+                                                                     *args),
+         True),
+    "LandSoldRecord.parse_web_page": (parse_web_page, False),
+}
+
+
+def load_fixture(name, encoding):
+    resp = requests.Response()
+    resp.status_code = 200
+    resp.url = "http://fixture/%s" % name
+    resp.encoding = encoding
+    with open(os.path.join(FIXTURE_DIR, name), "rb") as f:
+        resp._content = f.read()
+    return resp
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1,
+                max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def measure(func, number):
+    # warm up, e.g. compiled xpath
+    func()
+
+    seconds = []
+    for _ in range(number):
+        start_time = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start_time)
+    seconds.sort()
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"pages": number,
+            "pages_per_second": number / sum(seconds),
+            "p50_ms": percentile(seconds, 50) * 1000,
+            "p99_ms": percentile(seconds, 99) * 1000,
+            "peak_kib": peak / 1024}
+
+
+def run(number=100, backends=None, parser_names=None):
+    with open(os.path.join(FIXTURE_DIR, "index.json"),
+              encoding="utf-8") as f:
+        index = json.load(f)
+    backends = backends or sorted(parser.BACKENDS)
+
+    results = []
+    old_backend = parser.backend
+    try:
+        for backend in backends:
+            parser.set_backend(backend)
+            for fixture, entry in sorted(index.items()):
+                resp = load_fixture(fixture, entry["encoding"])
+                for name, args in sorted(entry["parsers"].items()):
+                    if parser_names and name not in parser_names:
+                        continue
+                    prepare, uses_backend = PARSERS[name]
+                    if not uses_backend and backend != backends[0]:
+                        continue
+                    result = {"parser": name,
+                              "backend": backend if uses_backend else None,
+                              "fixture": fixture,
+                              "bytes": len(resp.content)}
+                    result.update(measure(prepare(resp, *args), number))
+                    results.append(result)
+    finally:
+        parser.backend = old_backend
+
+    return {"python": platform.python_version(),
+            "number": number,
+            "counters": dict(parser.counters),
+            "results": results}
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    arg_parser.add_argument("-n", "--number", type=int, default=100,
+                            help="times to parse each page")
+    arg_parser.add_argument("-b", "--backend", action="append",
+                            choices=sorted(parser.BACKENDS))
+    arg_parser.add_argument("-p", "--parser", action="append",
+                            choices=sorted(PARSERS))
+    arg_parser.add_argument("-o", "--output", help="json file, default to"
+                                                   " stdout")
+    args = arg_parser.parse_args(argv)
+
+    result = run(args.number, args.backend, args.parser)
+    for r in result["results"]:
+        print("%-36s %-5s %8.1f pages/s  p50 %7.3f ms  p99 %7.3f ms  "
+              "peak %8.1f KiB" % (r["parser"], r["backend"] or "-",
+                                  r["pages_per_second"], r["p50_ms"],
+                                  r["p99_ms"], r["peak_kib"]),
+              file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,18 @@
 # coding=utf-8
 
 import types
+import datetime
 import unittest
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 
 from house_tracker import config, db
+from house_tracker.exceptions import LeaseError
 from house_tracker.models import (BatchJob, DistrictFD, CommunityFD, BatchJobFD,
-                                  DistrictJob, PresalePermit, base)
+                                  DistrictJob, PresalePermit, Job, base,
+                                  fangdi)
 
 
 class Test(unittest.TestCase):
@@ -89,6 +93,223 @@ class Test(unittest.TestCase):
 
         self.http_session.close()
 
+    def test_3(self):
+        """test leasing jobs by two workers"""
+        batch_job = BatchJob.get_batch_job(BatchJobFD, self.db_session,
+                                           create=True, force=True)
+        district_tmp = DistrictFD("test_tmp", 100)
+        self.db_session.add_all([district_tmp,
+                                 DistrictJob(self.district, batch_job),
+                                 DistrictJob(district_tmp, batch_job)])
+        self.db_session.commit()
+
+        other_session = db.Session()
+        batch_job.prepare_session(self.db_session)
+        other_batch_job = (other_session.query(BatchJobFD)
+                           .filter_by(batch_number=batch_job.batch_number)
+                           .one())
+        other_batch_job.prepare_session(other_session)
+
+        ttl = datetime.timedelta(seconds=60)
+        try:
+            job_1 = batch_job.lease_job("worker_1", ttl)
+            job_2 = other_batch_job.lease_job("worker_2", ttl)
+            self.assertTrue(job_1 is not None and job_2 is not None)
+            self.assertTrue(job_1.id != job_2.id)
+            self.assertTrue(batch_job.lease_job("worker_1", ttl) is None)
+
+            # expired lease can be taken by others
+            job_2.lease_expires_at = datetime.datetime.now() - ttl
+            other_session.commit()
+            job_3 = batch_job.lease_job("worker_1", ttl)
+            self.assertTrue(job_3 is not None and job_3.id == job_2.id)
+        finally:
+            other_session.close()
+            (self.db_session.query(DistrictJob)
+             .filter_by(batch_number=batch_job.batch_number,
+                        batch_type=batch_job.type)
+             .delete())
+            self.db_session.delete(district_tmp)
+            batch_job.status = base.FINISHED
+            self.db_session.commit()
+
+    def test_4(self):
+        """test check_presale_permits with a thread pool"""
+        content = self.district.fd_search(self.http_session, 1)
+        batch_job = BatchJob.get_batch_job(BatchJobFD, self.db_session,
+                                           create=True, force=True)
+        job = DistrictJob(self.district, batch_job)
+        job.prepare_session(self.db_session, self.http_session,
+                            auto_commit=False)
+
+        communities = []
+        for c_info in content["community_list"][:4]:
+            communities.append(CommunityFD(c_info.pop("name"),
+                                           c_info.pop("outer_id"),
+                                           self.district, **c_info))
+        # the same community twice, the permits should be added once
+        communities.append(communities[0])
+        self.db_session.add_all(communities)
+        self.db_session.flush()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            job.check_presale_permits(communities, executor)
+
+        for c in communities:
+            self.assertTrue(c.presale_url_name is not None)
+            self.assertTrue(len(c.presales) > 0)
+            serial_numbers = [p.serial_number for p in c.presales]
+            self.assertTrue(len(serial_numbers) == len(set(serial_numbers)))
+        self.http_session.close()
+
+    def test_5(self):
+        """test insert_communities"""
+        batch_job = BatchJob.get_batch_job(BatchJobFD, self.db_session,
+                                           create=True, force=True)
+        job = DistrictJob(self.district, batch_job)
+        job.prepare_session(self.db_session, self.http_session,
+                            auto_commit=False)
+
+        existing = CommunityFD("test_existing", "test_insert_0",
+                               self.district)
+        self.db_session.add(existing)
+        self.db_session.flush()
+
+        c_list = [{"outer_id": "test_insert_%s" % i, "name": "test_%s" % i,
+                   "location": "test", "total_number": i, "total_area": 1.0}
+                  for i in range(3)]
+        # the same community twice
+        c_list.append(dict(c_list[1]))
+        existing_outer_ids = {existing.outer_id: existing}
+        job.insert_communities(c_list, existing_outer_ids)
+
+        self.assertTrue(sorted(existing_outer_ids) == ["test_insert_0",
+                                                       "test_insert_1",
+                                                       "test_insert_2"])
+        self.assertTrue(existing_outer_ids["test_insert_0"] is existing)
+        for i in (1, 2):
+            c = existing_outer_ids["test_insert_%s" % i]
+            self.assertTrue(c.id is not None and c.track_presale)
+            self.assertTrue(c.name == "test_%s" % i and c.total_number == i)
+            self.assertTrue(c.district_id == self.district.id)
+        number = (self.db_session.query(func.count(CommunityFD.id))
+                  .filter(CommunityFD.outer_id.like("test_insert_%"))
+                  .scalar())
+        self.assertTrue(number == 3)
+
+    def test_6(self):
+        """test load_presales and update_presale_permit"""
+        batch_job = BatchJob.get_batch_job(BatchJobFD, self.db_session,
+                                           create=True, force=True)
+        job = DistrictJob(self.district, batch_job)
+        job.prepare_session(self.db_session, self.http_session,
+                            auto_commit=False)
+
+        c = CommunityFD("test_presale", "test_presale", self.district)
+        self.db_session.add(c)
+        self.db_session.add(PresalePermit(c, serial_number="test_1"))
+        self.db_session.flush()
+
+        known_presales = job.load_presales()
+        self.assertTrue((c.id, "test_1") in known_presales)
+
+        self.db_session.expire(c)
+        presales = [{"serial_number": "test_1"}, {"serial_number": "test_2"},
+                    {"serial_number": "test_2"}]
+        c.update_presale_permit(self.db_session, None, presales,
+                                known_presales)
+        self.db_session.flush()
+        self.assertTrue((c.id, "test_2") in known_presales)
+        self.assertTrue(sorted(p.serial_number for p in c.presales)
+                        == ["test_1", "test_2"])
+
+    def test_7(self):
+        """test a job stopped once its lease is taken by another worker"""
+        batch_job = BatchJob.get_batch_job(BatchJobFD, self.db_session,
+                                           create=True, force=True)
+        self.db_session.add(DistrictJob(self.district, batch_job))
+        self.db_session.commit()
+        batch_job.prepare_session(self.db_session)
+
+        ttl = datetime.timedelta(seconds=0.3)
+        job = batch_job.lease_job("worker_1", ttl)
+        other_session = db.Session()
+        pages = []
+
+        def search_func(http_session, page):
+            if page == 2:
+                # the lease expires during a long page, and is taken
+                (other_session.query(Job).filter_by(id=job.id)
+                 .update({Job.lease_owner: "worker_2"}))
+                other_session.commit()
+                lease.lost.wait(5)
+            pages.append(page)
+            return {"total_page": 3}
+
+        try:
+            with base.JobLease(self.db_session.get_bind(), job.id,
+                               "worker_1", ttl) as lease:
+                job.lease = lease
+                with self.assertRaises(LeaseError):
+                    for _ in base.PagesIterator(job, search_func):
+                        pass
+                self.assertTrue(pages == [1, 2], pages)
+                self.assertTrue(job.parameters["next_page"] == 3)
+
+                # nor is the status written
+                other_job = Job(batch_job)
+                other_job.lease = lease
+                with self.assertRaises(LeaseError):
+                    other_job.start(self.db_session, None, auto_commit=False)
+                self.assertTrue(other_job.status == base.READY)
+
+            self.db_session.rollback()
+            self.assertTrue(other_session.query(Job).get(job.id).lease_owner
+                            == "worker_2")
+        finally:
+            other_session.close()
+            self.db_session.rollback()
+            (self.db_session.query(Job)
+             .filter_by(batch_number=batch_job.batch_number,
+                        batch_type=batch_job.type)
+             .delete())
+            batch_job.status = base.FINISHED
+            self.db_session.commit()
+
+    def test_8(self):
+        """test the policies of the presale check"""
+        c = CommunityFD("test_policy", "test_policy", self.district,
+                        total_number=10, total_area=1000.5)
+        self.assertTrue(not c.listing_changed({"total_number": 10,
+                                               "total_area": 1000.504}))
+        self.assertTrue(c.listing_changed({"total_number": 11,
+                                           "total_area": 1000.5}))
+        self.assertTrue(c.listing_changed({"total_number": 10,
+                                           "total_area": 1001.5}))
+        self.assertTrue(c.listing_changed({"total_number": 10}))
+
+        same = {"total_number": 10, "total_area": 1000.5}
+        changed = {"total_number": 9, "total_area": 900.0}
+        for policy in (None, fangdi.POLICY_ALWAYS):
+            self.assertTrue(c.presale_reason(10, same, policy)
+                            == fangdi.PRESALE_ALWAYS)
+
+        policy = fangdi.POLICY_INCREMENTAL
+        self.assertTrue(c.presale_reason(10, same, policy)
+                        == fangdi.PRESALE_NEW)
+        c.presale_batch_number = 9
+        self.assertTrue(c.presale_reason(10, same, policy) is None)
+        self.assertTrue(c.presale_reason(10, changed, policy)
+                        == fangdi.PRESALE_CHANGED)
+        self.assertTrue(c.presale_reason(15, same, policy, max_age=7) is None)
+        self.assertTrue(c.presale_reason(16, same, policy, max_age=7)
+                        == fangdi.PRESALE_STALE)
+        self.assertTrue(c.presale_reason(16, same, policy, max_age=7,
+                                         sweep_every=8) == fangdi.PRESALE_SWEEP)
+
+        with self.assertRaises(ValueError):
+            c.presale_reason(10, same, "never")
+
     def test_9(self):
         cmd_args = types.SimpleNamespace(force=True, create=True)
         district_ids = [self.district.id]
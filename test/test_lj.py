@@ -1,15 +1,29 @@
 # coding=utf-8
 
+import os
+import zlib
 import types
+import tempfile
+import functools
 import unittest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 
 from house_tracker import config, db
+from house_tracker.engine import AsyncEngine
+from house_tracker.exceptions import DownloadError
 from house_tracker.models import (BatchJob, BatchJobLJ, District, Area,
                                   CommunityLJ, CommunityRecordLJ, HouseLJ,
-                                  HouseRecordLJ, base)
+                                  HouseRecordLJ, CommunityJob, CommunityFD,
+                                  DistrictFD, base, lianjia, set_base_url)
+from house_tracker.utils.cache import ResponseCache
+from house_tracker.utils.replay import ReplayServer
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
 
 
 class Test(unittest.TestCase):
@@ -60,7 +74,8 @@ class Test(unittest.TestCase):
         self.http_session.close()
 
     def test_1(self):
-        """test lj_search and load_detail"""
+        """test lj_search and the detail page"""
+        self.start_replay_server()
         info = self.community.lj_search(self.http_session, 1,
                                         self.config.lj_number_per_page)
         self.assertTrue(info["community_info"] is not None)
@@ -80,12 +95,215 @@ class Test(unittest.TestCase):
                                            create=True, force=True)
         c_record = CommunityRecordLJ(self.community, batch_job,
                                      **info["community_info"])
-        h_record = HouseRecordLJ(house, batch_job, price=h_info["price"])
-        h_record.load_detail(self.http_session)
+        detail = HouseLJ._lj_search(house.outer_id, self.http_session)
+        for key in ("view_last_week", "view_last_month", "date_to_market"):
+            self.assertTrue(detail.get(key) is not None, key)
+        h_record = HouseRecordLJ(house, batch_job, price=h_info["price"],
+                                 view_last_week=detail["view_last_week"],
+                                 view_last_month=detail["view_last_month"])
 
         self.db_session.add_all([batch_job, c_record, h_record])
         self.db_session.flush()
 
+    def test_2(self):
+        """test the detail pages searched by a thread pool"""
+        self.start_replay_server()
+        info = self.community.lj_search(self.http_session, 1,
+                                        self.config.lj_number_per_page)
+        batch_job = BatchJob.get_batch_job(BatchJobLJ, self.db_session,
+                                           create=True, force=True)
+        job = CommunityJob(self.community, batch_job)
+        self.db_session.add(job)
+        self.db_session.flush()
+        job.prepare_session(self.db_session, self.http_session,
+                            auto_commit=False)
+
+        houses_info = info["houses_info"][:4]
+        funcs = [functools.partial(HouseLJ._lj_search, h_info["outer_id"])
+                 for h_info in houses_info]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            details = job.search_details(funcs, executor)
+        reasons = [lianjia.DETAIL_NEW] * len(houses_info)
+
+        for h_info, detail in zip(houses_info, details):
+            row = job.house_values(None, h_info, lianjia.DETAIL_NEW, detail)
+            self.assertTrue(row["view_last_week"] == detail["view_last_week"])
+            self.assertTrue(row["detail_hash"] == detail["detail_hash"])
+        job.insert_houses(houses_info, reasons, details)
+
+        houses = (self.db_session.query(HouseLJ)
+                  .filter(HouseLJ.outer_id.in_([h_info["outer_id"]
+                                                for h_info in houses_info]))
+                  .filter_by(last_batch_number=batch_job.batch_number)
+                  .all())
+        self.assertTrue(len(houses) == len(houses_info))
+        for house in houses:
+            self.assertTrue(house.view_last_month is not None)
+            self.assertTrue(house.detail_batch_number
+                            == batch_job.batch_number)
+            self.assertTrue(house.house_records[0].view_last_week
+                            == house.view_last_week)
+
+    def test_3(self):
+        """test insert_houses"""
+        batch_job = BatchJob.get_batch_job(BatchJobLJ, self.db_session,
+                                           create=True, force=True)
+        job = CommunityJob(self.community, batch_job)
+        self.db_session.add(job)
+        self.db_session.flush()
+        job.prepare_session(self.db_session, self.http_session,
+                            auto_commit=False)
+
+        houses_info = [{"outer_id": "test_insert_%s" % i, "price": 100 + i,
+                        "build_year": 2000, "floor": "中区", "area": 50.0}
+                       for i in range(2)]
+        detail = {"view_last_week": 1, "view_last_month": 2,
+                  "detail_hash": "0" * 40}
+        job.insert_houses(houses_info, [lianjia.DETAIL_NEW, None],
+                          [detail, None])
+
+        houses = (self.db_session.query(HouseLJ)
+                  .filter(HouseLJ.outer_id.in_(["test_insert_0",
+                                                "test_insert_1"]))
+                  .order_by(HouseLJ.outer_id).all())
+        self.assertTrue(len(houses) == 2)
+        self.assertTrue(houses[0].price_origin == 100)
+        self.assertTrue(houses[0].detail_hash == detail["detail_hash"])
+        self.assertTrue(houses[0].detail_batch_number
+                        == batch_job.batch_number)
+        self.assertTrue(houses[1].detail_batch_number is None)
+
+        for house, source in zip(houses, (lianjia.DETAIL_NEW,
+                                          lianjia.DETAIL_SKIPPED)):
+            self.assertTrue(house.new and house.available)
+            self.assertTrue(len(house.house_records) == 1)
+            h_record = house.house_records[0]
+            self.assertTrue(h_record.batch_number == batch_job.batch_number)
+            self.assertTrue(h_record.detail_source == source)
+            self.assertTrue(h_record.view_last_week == house.view_last_week)
+
+    def test_4(self):
+        """test update_houses"""
+        batch_job = BatchJob.get_batch_job(BatchJobLJ, self.db_session,
+                                           create=True, force=True)
+        job = CommunityJob(self.community, batch_job)
+        self.db_session.add(job)
+        self.db_session.flush()
+        job.prepare_session(self.db_session, self.http_session,
+                            auto_commit=False)
+
+        houses = [HouseLJ("test_update_%s" % i, self.community, price=100)
+                  for i in range(2)]
+        houses[1].available = False
+        self.db_session.add_all(houses)
+        self.db_session.flush()
+
+        existing = job.load_houses()
+        detail = {"view_last_week": 1, "view_last_month": 2}
+        rows = [job.house_values(existing["test_update_0"],
+                                 {"price": 110}, lianjia.DETAIL_ALWAYS,
+                                 detail),
+                job.house_values(existing["test_update_1"],
+                                 {"price": 90}, None, None)]
+        job.update_houses(rows)
+
+        for house in houses:
+            self.db_session.refresh(house)
+            self.assertTrue(house.last_batch_number == batch_job.batch_number)
+            self.assertTrue(house.available and not house.new)
+        self.assertTrue(houses[0].price == 110)
+        self.assertTrue(houses[0].price_origin == 100)
+        self.assertTrue(houses[0].view_last_month == 2)
+        self.assertTrue(houses[0].detail_batch_number
+                        == batch_job.batch_number)
+        self.assertTrue(houses[1].price == 90)
+        self.assertTrue(houses[1].available_change_times == 1)
+        self.assertTrue(houses[1].detail_batch_number is None)
+
+    def test_5(self):
+        """test the counters of the batch job"""
+        batch_job = BatchJob.get_batch_job(BatchJobLJ, self.db_session,
+                                           create=True, force=True)
+        job = CommunityJob(self.community, batch_job)
+        self.db_session.add(job)
+        self.db_session.flush()
+        batch_job.prepare_session(self.db_session, auto_commit=False)
+        job.prepare_session(self.db_session, self.http_session,
+                            auto_commit=False)
+
+        houses_info = [{"outer_id": "test_counter_%s" % i, "price": 100}
+                       for i in range(2)]
+        job.insert_houses(houses_info, [None, None], [None, None])
+        self.assertTrue(job.new_number == 2 and job.record_number == 2)
+
+        BatchJob.add_counters(self.db_session, batch_job.batch_number,
+                              batch_job.type, record_number=2,
+                              available_number=2, new_number=2)
+        BatchJob.add_counters(self.db_session, batch_job.batch_number,
+                              batch_job.type, record_number=1,
+                              available_number=1, missing_number=1)
+        self.assertTrue(batch_job.get_counters()
+                        == {"record_number": 3, "available_number": 3,
+                            "new_number": 2, "missing_number": 1})
+
+    def test_6(self):
+        """test the conditional request of the detail page"""
+        info = self.start_replay_server(etag='"v1"')
+        outer_id = info["houses_info"][0]["outer_id"]
+
+        detail = HouseLJ._lj_search(outer_id, self.http_session)
+        self.assertTrue(detail["view_last_week"] is not None)
+        self.assertTrue(detail["detail_etag"] == '"v1"')
+        self.assertTrue(len(detail["detail_hash"]) == 40)
+
+        # 304 for the same etag
+        self.assertTrue(HouseLJ._lj_search(outer_id, self.http_session,
+                                           detail_etag='"v1"') is None)
+        # 200 of the same content with a new etag, only the validators
+        same = HouseLJ._lj_search(outer_id, self.http_session,
+                                  detail_etag='"v0"',
+                                  detail_hash=detail["detail_hash"])
+        self.assertTrue(same == {"detail_etag": '"v1"',
+                                 "detail_last_modified": None})
+
+        # written by house_values, the other columns are kept
+        batch_job = BatchJob.get_batch_job(BatchJobLJ, self.db_session,
+                                           create=True, force=True)
+        job = CommunityJob(self.community, batch_job)
+        house = dict.fromkeys(CommunityJob.tracked_columns, None)
+        house.update({"id": 1, "community_id": self.community.id,
+                      "outer_id": outer_id, "price": 100, "available": True,
+                      "view_last_week": 3, "detail_etag": '"v0"',
+                      "detail_hash": detail["detail_hash"]})
+        row = job.house_values(house, {"price": 100},
+                               lianjia.DETAIL_ALWAYS, same)
+        self.assertTrue(row["detail_etag"] == '"v1"')
+        self.assertTrue(row["view_last_week"] == 3)
+        self.assertTrue(row["detail_hash"] == detail["detail_hash"])
+        # 200 of changed content
+        changed = HouseLJ._lj_search(outer_id, self.http_session,
+                                     detail_etag='"v0"', detail_hash="0" * 40)
+        self.assertTrue(changed == detail)
+
+    def test_7(self):
+        """test the policies of the detail page"""
+        reason = HouseLJ._detail_reason
+        for policy in (None, lianjia.POLICY_ALWAYS):
+            self.assertTrue(reason(10, 10, 0, policy) == lianjia.DETAIL_ALWAYS)
+
+        policy = lianjia.POLICY_INCREMENTAL
+        self.assertTrue(reason(None, 10, None, policy) == lianjia.DETAIL_NEW)
+        self.assertTrue(reason(9, 10, -5, policy) == lianjia.DETAIL_PRICE)
+        self.assertTrue(reason(9, 10, 0, policy) is None)
+        self.assertTrue(reason(3, 10, 0, policy, max_age=7)
+                        == lianjia.DETAIL_STALE)
+        self.assertTrue(reason(4, 10, 0, policy, max_age=7) is None)
+        # no max age
+        self.assertTrue(reason(1, 10, 0, policy) is None)
+
+        with self.assertRaises(ValueError):
+            reason(9, 10, 0, "never")
+
     def test_9(self):
         cmd_args = types.SimpleNamespace(force=False, create=False)
         community_outer_ids = [self.community.outer_id]
@@ -106,9 +324,210 @@ class Test(unittest.TestCase):
 
         self.assertTrue(batch_job.status == base.FINISHED)
 
+    def start_replay_server(self, etag=None):
+        """Serve one page of the community and the detail pages of its
+        houses, made from the fixtures, and send the requests of the
+        crawlers to it until the end of the test. The detail pages have the
+        ETag if given."""
+        with open(os.path.join(FIXTURE_DIR, "lj_community.html"), "rb") as f:
+            # 30 houses on one page
+            community_page = f.read().replace("> 45 <".encode(),
+                                              "> 30 <".encode())
+        with open(os.path.join(FIXTURE_DIR, "lj_house.html"), "rb") as f:
+            house_page = f.read()
+
+        def response(url, content, etag=None):
+            resp = requests.Response()
+            resp.status_code = 200
+            resp.url = url
+            resp.headers["Content-Type"] = "text/html; charset=utf-8"
+            if etag is not None:
+                resp.headers["ETag"] = etag
+            resp._content = content
+            return resp
+
+        directory = tempfile.mkdtemp(prefix="house_tracker_replay_")
+        cache = ResponseCache(directory)
+        url = CommunityLJ.SEARCH_URL % (1, self.community.outer_id)
+        cache.put(url, response(url, community_page))
+        info = CommunityLJ._lj_parse(response(url, community_page), 1,
+                                     self.config.lj_number_per_page)
+        for h_info in info["houses_info"]:
+            url = HouseLJ.SEARCH_URL % h_info["outer_id"]
+            content = house_page.replace(b"107000000001",
+                                         h_info["outer_id"].encode())
+            cache.put(url, response(url, content, etag))
+
+        server = ReplayServer(directory, ("127.0.0.1", 0))
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        # set_base_url changes the urls of all the crawlers
+        urls = [(cls, dict(vars(cls))) for cls in (CommunityLJ, HouseLJ,
+                                                    CommunityFD, DistrictFD)]
+        set_base_url(server.base_url)
+
+        def stop():
+            for cls, attrs in urls:
+                for name, value in attrs.items():
+                    if name.endswith("_URL"):
+                        setattr(cls, name, value)
+            server.shutdown()
+            server.server_close()
+        self.addCleanup(stop)
+        return info
+
+    def test_10(self):
+        """test run_batch with the async engine, against the replay
+        server"""
+        info = self.start_replay_server()
+        cmd_args = types.SimpleNamespace(force=True, create=True)
+        community_outer_ids = [self.community.outer_id]
+
+        batch_job = BatchJob.run_batch(BatchJobLJ, config=self.config,
+                                       cmd_args=cmd_args,
+                                       db_session=self.db_session,
+                                       community_outer_ids=community_outer_ids,
+                                       lj_number_per_page=self.config.lj_number_per_page,
+                                       engine=AsyncEngine(2, 2))
+
+        self.assertTrue(batch_job.status == base.FINISHED)
+        for job in batch_job.jobs:
+            self.assertTrue(job.status == base.FINISHED, job.id)
+        self.assertTrue(batch_job.get_counters()["record_number"]
+                        == len(info["houses_info"]))
+
+
+    def test_11(self):
+        """test the shards of the communities"""
+        outer_ids = ["test_shard_%s" % i for i in range(8)]
+        for shards in (1, 2, 3):
+            for outer_id in outer_ids:
+                shard = CommunityLJ.shard_of(outer_id, shards)
+                self.assertTrue(0 <= shard < shards)
+                # the same in every process
+                self.assertTrue(shard == zlib.crc32(outer_id.encode())
+                                % shards)
+
+        self.db_session.add_all([CommunityLJ(outer_id, outer_id, self.area)
+                                 for outer_id in outer_ids])
+        self.db_session.flush()
+        batch_job = BatchJob.get_batch_job(BatchJobLJ, self.db_session,
+                                           create=True, force=True)
+        batch_job.prepare_session(self.db_session, auto_commit=False)
+
+        tracked = []
+        for i in range(3):
+            jobs = batch_job.get_jobs(outer_ids, (i, 3))
+            for job in jobs:
+                self.assertTrue(
+                    CommunityLJ.shard_of(job.community.outer_id, 3) == i)
+            tracked += [job.community.outer_id for job in jobs]
+        self.assertTrue(sorted(tracked) == outer_ids, tracked)
+
+        # jobs are created once, and the finished ones are left out
+        jobs = batch_job.get_jobs(outer_ids, (0, 1))
+        self.assertTrue(len(jobs) == len(outer_ids))
+        jobs[0].status = base.FINISHED
+        self.assertTrue(len(batch_job.get_jobs(outer_ids)) == len(jobs) - 1)
+
+    def test_12(self):
+        """test the status of a batch job set by the shards"""
+        batch_job = BatchJob.get_batch_job(BatchJobLJ, self.db_session,
+                                           create=True, force=True)
+        self.db_session.commit()
+        other_session = db.Session()
+        other_batch_job = (other_session.query(BatchJobLJ)
+                           .filter_by(batch_number=batch_job.batch_number)
+                           .one())
+        try:
+            batch_job.prepare_session(self.db_session, auto_commit=True)
+            other_batch_job.prepare_session(other_session, auto_commit=True)
+            for b in (batch_job, other_batch_job):
+                b.started_status = base.READY
+
+            # the first shard done, and the last one
+            self.assertTrue(batch_job.set_status(base.RUNNING))
+            self.assertTrue(other_batch_job.set_status(base.FINISHED))
+            # the result is not overwritten by a shard left behind
+            self.assertTrue(not batch_job.set_status(base.RUNNING))
+            self.assertTrue(not batch_job.set_status(base.FAILED))
+            self.assertTrue(batch_job.status == base.FINISHED)
+
+            # shards of a failed batch job started again
+            other_batch_job.status = base.FAILED
+            other_session.commit()
+            for b in (batch_job, other_batch_job):
+                b.db_session.refresh(b)
+                b.started_status = b.status
+            self.assertTrue(other_batch_job.set_status(base.RUNNING))
+            self.assertTrue(batch_job.set_status(base.FINISHED))
+            self.assertTrue(not other_batch_job.set_status(base.RUNNING))
+            self.assertTrue(other_batch_job.status == base.FINISHED)
+        finally:
+            other_session.close()
+
+    def test_13(self):
+        """test the counters of a community job resumed after a failed
+        page"""
+        info = self.start_replay_server()
+        houses_info = info["houses_info"]
+        community = CommunityLJ("test_resume", "test_resume", self.area)
+        batch_job = BatchJob.get_batch_job(BatchJobLJ, self.db_session,
+                                           create=True, force=True)
+        job = CommunityJob(community, batch_job)
+        self.db_session.add_all([community, job])
+        self.db_session.commit()
+        batch_job.prepare_session(self.db_session, self.http_session)
+
+        def delete(community_id):
+            # or check_result of the other batches would fail
+            for cls in (HouseRecordLJ, HouseLJ, CommunityRecordLJ,
+                        CommunityJob):
+                (self.db_session.query(cls)
+                 .filter_by(community_id=community_id)
+                 .delete(synchronize_session=False))
+            (self.db_session.query(CommunityLJ).filter_by(id=community_id)
+             .delete(synchronize_session=False))
+            self.db_session.commit()
+        self.addCleanup(delete, community.id)
+
+        # two pages, the last house of page 1 listed again on page 2, and
+        # page 2 failed the first time
+        pages = {1: houses_info[:15], 2: houses_info[14:]}
+        failures = [DownloadError("page 2")]
+
+        def search(http_session, page):
+            if page == 2 and failures:
+                raise failures.pop()
+            return {"community_info": dict(info["community_info"])
+                    if page == 1 else None,
+                    "houses_info": [dict(h_info) for h_info in pages[page]],
+                    "total_page": 2}
+        community.lj_search_func = lambda number_per_page=None: search
+
+        self.assertTrue(batch_job.run_job(job, self.db_session,
+                                          self.http_session) == base.FAILED)
+        self.assertTrue(job.parameters["next_page"] == 2)
+        job.status = base.RETRY
+        self.db_session.commit()
+        self.assertTrue(batch_job.run_job(job, self.db_session,
+                                          self.http_session) == base.FINISHED)
+
+        record_number = self.db_session.execute(
+            CommunityJob.record_number_query(batch_job.batch_number,
+                                             community.id)).scalar()
+        self.assertTrue(record_number == len(houses_info))
+        self.assertTrue(batch_job.get_counters()
+                        == {"record_number": len(houses_info),
+                            "available_number": len(houses_info),
+                            "new_number": len(houses_info),
+                            "missing_number": 0})
+        self.assertTrue(batch_job.sum_community_records().new_number
+                        == len(houses_info))
+
 
 """
 session.add(Community(outer_id='5011000018309', name=u'万邦都市花园',
                       district=u'浦东新区'))
 session.add(Community(outer_id='5011000012349', name=u'浦东星河湾',
-                      district=u'浦东新区'))"""
\ No newline at end of file
+                      district=u'浦东新区'))"""